@@ -9,11 +9,14 @@ import os
 import tempfile
 import uuid
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for, make_response
+from flask import Flask, render_template, request, Response, send_file, flash, redirect, url_for, make_response
 from werkzeug.utils import secure_filename
 import json
 import logging
 
+import orjson
+import requests
+
 # 导入现有的处理模块
 from image_analyzer import ImageAnalyzer, ImageAnalysisError
 from url_image_extractor import URLImageExtractor
@@ -43,6 +46,15 @@ logger = logging.getLogger(__name__)
 
 # 移除了文件上传相关的辅助函数
 
+def ojsonify(payload, status=200):
+    """使用orjson序列化JSON响应，比flask.jsonify更快"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+def _load_json():
+    """使用orjson解析请求体，请求体为空时返回None"""
+    raw = request.get_data(cache=False)
+    return orjson.loads(raw) if raw else None
+
 @app.route('/')
 def home():
     """主页"""
@@ -66,9 +78,9 @@ def image_extractor():
 def analyze_svg():
     """分析SVG代码中的图片"""
     try:
-        data = request.get_json()
+        data = _load_json()
         if not data or 'svg_content' not in data:
-            return jsonify({'error': 'SVG内容不能为空'}), 400
+            return ojsonify({'error': 'SVG内容不能为空'}, 400)
         
         svg_content = data['svg_content']
         logger.info("开始分析SVG代码中的图片")
@@ -76,19 +88,21 @@ def analyze_svg():
         # 分析图片
         image_results = image_analyzer.analyze_svg_images(svg_content)
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'images': image_results,
             'total_count': len(image_results),
             'large_count': sum(1 for img in image_results if img['is_large'])
         })
         
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': '请求数据不是有效的JSON'}, 400)
     except ImageAnalysisError as e:
         logger.error(f"SVG分析失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
     except Exception as e:
         logger.error(f"分析SVG时发生未知错误: {str(e)}")
-        return jsonify({'error': f'分析失败: {str(e)}'}), 500
+        return ojsonify({'error': f'分析失败: {str(e)}'}, 500)
 
 @app.route('/image_proxy')
 def image_proxy():
@@ -96,7 +110,7 @@ def image_proxy():
     try:
         url = request.args.get('url')
         if not url:
-            return jsonify({'error': '缺少URL参数'}), 400
+            return ojsonify({'error': '缺少URL参数'}, 400)
         
         # 设置请求头，特别是对微信图片的处理
         headers = {
@@ -114,17 +128,15 @@ def image_proxy():
             })
         
         # 发送请求获取图片
-        import requests
         response = requests.get(url, headers=headers, timeout=10, stream=True)
         response.raise_for_status()
         
         # 检查是否是图片内容
         content_type = response.headers.get('content-type', '')
         if not content_type.startswith('image/'):
-            return jsonify({'error': '不是有效的图片内容'}), 400
+            return ojsonify({'error': '不是有效的图片内容'}, 400)
         
         # 返回图片数据
-        from flask import Response
         return Response(
             response.content,
             content_type=content_type,
@@ -136,18 +148,18 @@ def image_proxy():
         
     except Exception as e:
         logger.error(f"图片代理出错: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/replace_url', methods=['POST'])
 def replace_url():
     """替换单个图片URL"""
     try:
-        data = request.get_json()
+        data = _load_json()
         required_fields = ['svg_content', 'old_url', 'new_url']
         
         for field in required_fields:
             if not data or field not in data:
-                return jsonify({'error': f'缺少必要参数: {field}'}), 400
+                return ojsonify({'error': f'缺少必要参数: {field}'}, 400)
         
         svg_content = data['svg_content']
         old_url = data['old_url']
@@ -158,53 +170,57 @@ def replace_url():
         # 执行替换
         updated_content = image_analyzer.replace_url_in_svg(svg_content, old_url, new_url)
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'updated_content': updated_content
         })
         
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': '请求数据不是有效的JSON'}, 400)
     except ImageAnalysisError as e:
         logger.error(f"URL替换失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
     except Exception as e:
         logger.error(f"替换URL时发生未知错误: {str(e)}")
-        return jsonify({'error': f'替换失败: {str(e)}'}), 500
+        return ojsonify({'error': f'替换失败: {str(e)}'}, 500)
 
 @app.route('/extract_images', methods=['POST'])
 def extract_images():
     """从URL抓取图片"""
     try:
-        data = request.get_json()
+        data = _load_json()
         if not data or 'url' not in data:
-            return jsonify({'error': 'URL不能为空'}), 400
+            return ojsonify({'error': 'URL不能为空'}, 400)
         
         url = data['url'].strip()
         if not url:
-            return jsonify({'error': 'URL不能为空'}), 400
+            return ojsonify({'error': 'URL不能为空'}, 400)
         
         logger.info(f"开始抓取URL图片: {url}")
         
         # 抓取图片
         images = url_extractor.extract_images_from_url(url)
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'images': images,
             'total_count': len(images),
             'url': url
         })
         
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': '请求数据不是有效的JSON'}, 400)
     except Exception as e:
         logger.error(f"抓取图片失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/download_image', methods=['POST'])
 def download_image():
     """下载单张图片"""
     try:
-        data = request.get_json()
+        data = _load_json()
         if not data or 'image_info' not in data:
-            return jsonify({'error': '图片信息不能为空'}), 400
+            return ojsonify({'error': '图片信息不能为空'}, 400)
         
         image_info = data['image_info']
         logger.info(f"开始下载图片: {image_info.get('url')}")
@@ -212,22 +228,24 @@ def download_image():
         # 下载图片
         downloaded_image = url_extractor.download_image(image_info)
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'image': downloaded_image
         })
         
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': '请求数据不是有效的JSON'}, 400)
     except Exception as e:
         logger.error(f"下载图片失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/download_all_images', methods=['POST'])
 def download_all_images():
     """批量下载所有图片"""
     try:
-        data = request.get_json()
+        data = _load_json()
         if not data or 'images' not in data:
-            return jsonify({'error': '图片列表不能为空'}), 400
+            return ojsonify({'error': '图片列表不能为空'}, 400)
         
         images = data['images']
         logger.info(f"开始批量下载 {len(images)} 张图片")
@@ -235,28 +253,30 @@ def download_all_images():
         # 批量下载图片
         downloaded_images = url_extractor.download_all_images(images)
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'images': downloaded_images,
             'downloaded_count': sum(1 for img in downloaded_images if img.get('downloaded'))
         })
         
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': '请求数据不是有效的JSON'}, 400)
     except Exception as e:
         logger.error(f"批量下载失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/create_archive', methods=['POST'])
 def create_archive():
     """创建下载压缩包"""
     try:
-        data = request.get_json()
+        data = _load_json()
         if not data or 'images' not in data:
-            return jsonify({'error': '图片列表不能为空'}), 400
+            return ojsonify({'error': '图片列表不能为空'}, 400)
         
         images = data['images']
         
         if not images:
-            return jsonify({'error': '没有可打包的图片'}), 400
+            return ojsonify({'error': '没有可打包的图片'}, 400)
         
         logger.info(f"开始创建压缩包，包含 {len(images)} 张图片")
         
@@ -264,7 +284,7 @@ def create_archive():
         result = url_extractor.create_download_archive(images)
         
         if result['success']:
-            return jsonify({
+            return ojsonify({
                 'success': True,
                 'archive_name': result['archive_name'],
                 'archive_path': result['archive_path'],
@@ -272,11 +292,13 @@ def create_archive():
                 'downloaded_count': result['downloaded_count']
             })
         else:
-            return jsonify({'error': result['error']}), 500
+            return ojsonify({'error': result['error']}, 500)
         
+    except orjson.JSONDecodeError:
+        return ojsonify({'error': '请求数据不是有效的JSON'}, 400)
     except Exception as e:
         logger.error(f"创建压缩包失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/download_file/<filename>')
 def download_file(filename):
@@ -284,33 +306,33 @@ def download_file(filename):
     try:
         file_path = os.path.join(url_extractor.download_folder, filename)
         if not os.path.exists(file_path):
-            return jsonify({'error': '文件不存在'}), 404
+            return ojsonify({'error': '文件不存在'}, 404)
         
         return send_file(file_path, as_attachment=True, download_name=filename)
         
     except Exception as e:
         logger.error(f"下载文件失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 # 保留/process路由以防有其他地方调用，但简化功能
 @app.route('/process', methods=['POST'])
 def process_document():
     """简化的处理接口（已弃用，请使用新的SVG分析功能）"""
-    return jsonify({
+    return ojsonify({
         'success': False,
         'error': '此功能已弃用，请使用新的SVG分析功能',
         'redirect': '/'
-    }), 400
+    }, 400)
 
 # 移除了自动微信上传功能相关代码
 
 @app.errorhandler(413)
 def too_large(e):
-    return jsonify({'error': '文件太大，最大支持16MB'}), 413
+    return ojsonify({'error': '文件太大，最大支持16MB'}, 413)
 
 @app.errorhandler(500)
 def internal_error(e):
-    return jsonify({'error': '服务器内部错误'}), 500
+    return ojsonify({'error': '服务器内部错误'}, 500)
 
 if __name__ == '__main__':
     print("🚀 图片地址替换工具 Web版本启动中...")
@@ -16,14 +16,48 @@ WECHAT_SECRET = os.getenv('WECHAT_SECRET', '')
 # 文件路径配置
 DOWNLOAD_DIR = 'downloads'  # 图片下载目录
 LOG_DIR = 'logs'  # 日志目录
+CACHE_DIR = 'cache'  # 图片缓存目录，按URL哈希保存，下载目录中的文件硬链接到这里
+WECHAT_TOKEN_FILE = os.path.join(CACHE_DIR, 'wechat_token.json')  # 保存微信访问令牌的文件，设为空则不保存
+UPLOAD_CACHE_FILE = os.path.join(CACHE_DIR, 'wechat_uploads.jsonl')  # 按内容哈希记录已上传的永久图片，再次运行时不重复上传，设为空则不记录
 
 # 图片配置
 MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 最大图片大小 10MB
 SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+INLINE_VERIFY_MAX_SIZE = 16 * 1024 * 1024  # 严格校验时，不超过该大小的图片在内存中直接验证，不再重新读取文件
+STRICT_IMAGE_VERIFY = False  # 是否用PIL完整校验下载的图片，默认只检查文件头
+IMAGE_PROBE_RANGE_BYTES = 64 * 1024  # 获取网页图片尺寸时最多请求的图片头字节数
+
+# 文档处理配置
+MMAP_THRESHOLD = 8 * 1024 * 1024  # 文本文件超过该大小时使用mmap扫描
+HTML_PARSE_REPLACE = False  # 替换HTML中的URL时是否用BeautifulSoup按标签属性替换（会重新序列化文档）
 
 # 请求配置
 REQUEST_TIMEOUT = 30  # 请求超时时间
 MAX_RETRIES = 3  # 最大重试次数
+DOWNLOAD_HEAD_PREFLIGHT = False  # 下载前是否先发送HEAD请求检查类型和大小
+HEAD_PREFLIGHT_TIMEOUT = 3  # HEAD预检请求超时时间
+
+# 缓存配置
+IMAGE_SIZE_CACHE_TTL = 3600  # 图片大小缓存有效期（秒）
+IMAGE_SIZE_CACHE_MAXSIZE = 4096  # 图片大小缓存的最大条目数
+EXTRACTOR_BODY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 网页图片抓取时暂存图片内容的总大小上限
+EXTRACTOR_BODY_CACHE_ENTRY_MAX_BYTES = 2 * 1024 * 1024  # 超过该大小的图片不暂存，下载时重新请求
+EXTRACTOR_BODY_CACHE_TTL = 300  # 暂存的图片内容的有效期（秒），过期后释放
+CACHE_REVALIDATE = False  # 命中图片缓存时是否仍发送条件请求确认图片未变化
+
+# 并发配置
+# 默认下载并发数，可通过环境变量IMGTOOL_CONCURRENCY覆盖
+DEFAULT_DOWNLOAD_CONCURRENCY = int(os.getenv('IMGTOOL_CONCURRENCY', min(32, (os.cpu_count() or 4) * 8)))
+DOWNLOAD_PER_HOST_LIMIT = 8  # 同一主机的最大并发下载数
+ANALYZE_MAX_WORKERS = 16  # SVG图片分析的最大并发数
+PROBE_MAX_WORKERS = 16  # 网页图片信息获取的最大并发数
+EXTRACTOR_RATE_PER_HOST = 10  # 网页图片抓取时每个主机每秒最多发出的请求数
+PARALLEL_MIN_FILES = 4  # 目录中文件数达到该值时才启用多进程处理
+UPLOAD_CONCURRENCY = 6  # 批量上传到微信公众号的最大并发数
+UPLOAD_RATE_LIMIT = 10  # 永久图片接口（uploadimg）每秒最多发出的上传请求数
+MEDIA_UPLOAD_RATE_LIMIT = 10  # 临时素材接口（media/upload）每秒最多发出的上传请求数
+UPLOAD_BACKOFF_MAX = 30  # 上传重试的最长等待时间（秒）
+UPLOAD_SEND_BLOCKSIZE = 256 * 1024  # 上传时每次写入连接的请求体字节数
 
 # 日志配置
 LOG_LEVEL = 'INFO'
@@ -8,10 +8,26 @@ import re
 import logging
 from typing import List, Dict, Tuple, Optional
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
 
-from utils import extract_image_urls_from_text, is_valid_image_url
+import config
+from utils import (
+    extract_image_urls_from_text, extract_image_urls_from_large_file, is_valid_image_url, read_text_file,
+    setup_worker_logging
+)
+
+
+# Markdown图片语法: ![alt](url)
+_MD_IMG_RE = re.compile(r'!\[[^\]]*?\]\((https?://[^\s)]+)\)')
+# CSS背景图片
+_BG_RE = re.compile(r'background-image:\s*url\(["\']?(https?://[^"\')\s]+)["\']?\)', re.IGNORECASE)
+# URL中的图片扩展名（与原先的子串判断一致，不要求出现在末尾）
+_IMG_EXT_RE = re.compile(r'\.(?:jpe?g|png|gif|bmp|webp)', re.IGNORECASE)
+# HTML解析失败时的备用img标签匹配
+_IMG_FALLBACK_RE = re.compile(r'<img[^>]+src=["\']?(https?://[^"\'>\s]+)["\']?[^>]*>', re.IGNORECASE)
 
 
 class DocumentProcessor:
@@ -63,9 +79,14 @@ class DocumentProcessor:
             processor = self.supported_formats[file_ext]
             image_urls = processor(file_path)
             
-            # 去重并验证URL
-            unique_urls = list(set(image_urls))
-            valid_urls = [url for url in unique_urls if is_valid_image_url(url)]
+            # 去重并验证URL（单次遍历，保持原始顺序）
+            seen = set()
+            valid_urls = []
+            for url in image_urls:
+                if url not in seen:
+                    seen.add(url)
+                    if is_valid_image_url(url):
+                        valid_urls.append(url)
             
             result.update({
                 'success': True,
@@ -94,23 +115,11 @@ class DocumentProcessor:
         Returns:
             图片URL列表
         """
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            # 尝试其他编码
-            encodings = ['gbk', 'gb2312', 'latin1']
-            content = None
-            for encoding in encodings:
-                try:
-                    with open(file_path, 'r', encoding=encoding) as f:
-                        content = f.read()
-                    break
-                except UnicodeDecodeError:
-                    continue
-            
-            if content is None:
-                raise ValueError("无法解码文件内容")
+        # 大文件通过mmap扫描，避免同时持有原始字节和解码后的字符串
+        if os.path.getsize(file_path) >= config.MMAP_THRESHOLD:
+            return extract_image_urls_from_large_file(file_path)
+        
+        content = read_text_file(file_path)
         
         return extract_image_urls_from_text(content)
     
@@ -129,11 +138,10 @@ class DocumentProcessor:
         image_urls = []
         
         # 提取Markdown图片语法: ![alt](url)
-        md_image_pattern = r'!\[.*?\]\((https?://[^\s\)]+)\)'
-        md_urls = re.findall(md_image_pattern, content, re.IGNORECASE)
+        md_urls = _MD_IMG_RE.findall(content)
         # 过滤出图片URL
         for url in md_urls:
-            if any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']) or '?' in url:
+            if '?' in url or _IMG_EXT_RE.search(url):
                 image_urls.append(url)
         
         # 提取HTML img标签
@@ -172,10 +180,14 @@ class DocumentProcessor:
         image_urls = []
         
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
+            try:
+                tree = lxml.html.fromstring(html_content)
+                img_tags = tree.iter('img')
+            except lxml.etree.ParserError:
+                # 文档为空（空白或仅含注释），没有img标签
+                img_tags = []
             
             # 提取img标签的src属性
-            img_tags = soup.find_all('img')
             for img in img_tags:
                 src = img.get('src')
                 if src and src.startswith(('http://', 'https://')):
@@ -187,17 +199,13 @@ class DocumentProcessor:
                     image_urls.append(data_src)
             
             # 提取CSS背景图片
-            style_pattern = r'background-image:\s*url\(["\']?(https?://[^"\')\s]+)["\']?\)'
-            css_urls = re.findall(style_pattern, html_content, re.IGNORECASE)
-            image_urls.extend(css_urls)
+            image_urls.extend(_BG_RE.findall(html_content))
             
         except Exception as e:
             self.logger.warning(f"HTML解析失败，使用正则表达式: {str(e)}")
             
             # 备用方案：使用正则表达式
-            img_pattern = r'<img[^>]+src=["\']?(https?://[^"\'>\s]+)["\']?[^>]*>'
-            regex_urls = re.findall(img_pattern, html_content, re.IGNORECASE)
-            image_urls.extend(regex_urls)
+            image_urls.extend(_IMG_FALLBACK_RE.findall(html_content))
         
         return image_urls
     
@@ -219,29 +227,37 @@ class DocumentProcessor:
         
         self.logger.info(f"开始处理目录: {directory_path} (递归: {recursive})")
         
-        results = []
-        file_count = 0
-        
-        # 遍历目录
+        # 遍历目录，先收集所有待处理的文件
+        file_paths = []
+        suffixes = tuple(self.supported_formats)
         if recursive:
             for root, dirs, files in os.walk(directory_path):
                 for file in files:
-                    file_path = os.path.join(root, file)
-                    if Path(file_path).suffix.lower() in self.supported_formats:
-                        result = self.extract_images_from_file(file_path)
-                        results.append(result)
-                        file_count += 1
+                    if file.lower().endswith(suffixes):
+                        file_paths.append(os.path.join(root, file))
         else:
-            for file in os.listdir(directory_path):
-                file_path = os.path.join(directory_path, file)
-                if os.path.isfile(file_path) and Path(file_path).suffix.lower() in self.supported_formats:
-                    result = self.extract_images_from_file(file_path)
-                    results.append(result)
-                    file_count += 1
+            # scandir的DirEntry缓存了类型信息，无需为每个条目单独stat
+            with os.scandir(directory_path) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(suffixes):
+                        file_paths.append(entry.path)
+        
+        file_count = len(file_paths)
+        
+        # 文件之间互不依赖，文件较多时使用多进程并行解析（绕过GIL）
+        if file_count >= config.PARALLEL_MIN_FILES:
+            with ProcessPoolExecutor(initializer=setup_worker_logging) as executor:
+                results = list(executor.map(self.extract_images_from_file, file_paths, chunksize=8))
+        else:
+            results = [self.extract_images_from_file(file_path) for file_path in file_paths]
         
         # 统计结果
-        successful_files = sum(1 for r in results if r['success'])
-        total_images = sum(r['total_images'] for r in results if r['success'])
+        successful_files = 0
+        total_images = 0
+        for r in results:
+            if r['success']:
+                successful_files += 1
+                total_images += r['total_images']
         
         self.logger.info(f"目录处理完成: 处理了 {file_count} 个文件，成功 {successful_files} 个，共找到 {total_images} 个图片URL")
         
@@ -267,18 +283,15 @@ class DocumentProcessor:
         Returns:
             唯一图片URL列表
         """
-        all_urls = []
-        for result in results:
-            if result['success']:
-                all_urls.extend(result['image_urls'])
-        
-        # 去重并保持顺序
+        # 单次遍历完成收集与去重，保持顺序
         unique_urls = []
         seen = set()
-        for url in all_urls:
-            if url not in seen:
-                unique_urls.append(url)
-                seen.add(url)
+        for result in results:
+            if result['success']:
+                for url in result['image_urls']:
+                    if url not in seen:
+                        unique_urls.append(url)
+                        seen.add(url)
         
         return unique_urls
     
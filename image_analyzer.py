@@ -1,66 +1,73 @@
+import html
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import urlparse
 from typing import List, Dict, Tuple, Optional
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from exceptions import ImageAnalysisError
 from PIL import Image
 import io
 
+import config
+
 logger = logging.getLogger(__name__)
 
+# 文件大小单位，下标即1024的幂次
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB')
+
+# 匹配SVG中的图片URL：src/href/xlink:href属性值以及CSS url()，
+# 包括常见图片扩展名结尾的URL、微信公众号图床(mmbiz/mmecoa.qpic.cn)和oss.e2.cool图床
+_SVG_IMAGE_URL_RE = re.compile(
+    r'''(?:src|href)=["']([^"'>]+?\.(?:jpg|jpeg|png|gif|webp|svg)'''
+    r'''|[^"'>]*?(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn|oss\.e2\.cool)[^"'>]*)["']'''
+    r'''|url\(["']?([^"')>]+?\.(?:jpg|jpeg|png|gif|webp|svg)'''
+    r'''|[^"')>]*?(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn|oss\.e2\.cool)[^"')>]*)["']?\)''',
+    re.IGNORECASE
+)
+
 class ImageAnalyzer:
     """图片分析器 - 用于分析SVG代码中的图片并检测大小"""
     
     def __init__(self):
         self.session = requests.Session()
         self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            # 不压缩响应，Content-Length即为图片的真实大小
+            'Accept-Encoding': 'identity'
         })
+        
+        # 同一图床的大量HEAD/GET请求复用连接，避免重复的TCP+TLS握手
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=64,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        # 图片大小缓存: {url: (过期时间, (字节数, 格式化大小))}
+        self._size_cache: OrderedDict = OrderedDict()
+        self._size_cache_lock = threading.Lock()
     
     def extract_image_urls_from_svg(self, svg_content: str) -> List[str]:
         """从SVG代码中提取所有图片URL"""
         try:
             # 先处理HTML编码
-            import html
             decoded_content = html.unescape(svg_content)
             
-            # 匹配各种图片URL模式
-            patterns = [
-                # 传统图片扩展名结尾的URL
-                r'src=["\']([^"\'>]+\.(jpg|jpeg|png|gif|webp|svg))["\']',  # src属性
-                r'href=["\']([^"\'>]+\.(jpg|jpeg|png|gif|webp|svg))["\']',  # href属性
-                r'url\(["\']?([^"\')>]+\.(jpg|jpeg|png|gif|webp|svg))["\']?\)',  # CSS url()
-                r'background-image:[^;]*url\(["\']?([^"\')>]+\.(jpg|jpeg|png|gif|webp|svg))["\']?\)',  # background-image
-                r'xlink:href=["\']([^"\'>]+\.(jpg|jpeg|png|gif|webp|svg))["\']',  # xlink:href
-                
-                # 微信公众号图床URL（支持各种属性和CSS样式）
-                r'src=["\']([^"\'>]*(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn)[^"\'>]*)["\']',  # src属性中的微信图床
-                r'href=["\']([^"\'>]*(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn)[^"\'>]*)["\']',  # href属性中的微信图床
-                r'url\(["\']?([^"\')>]*(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn)[^"\')>]*)["\']?\)',  # CSS url()中的微信图床
-                r'background-image:[^;]*url\(["\']?([^"\')>]*(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn)[^"\')>]*)["\']?\)',  # background-image中的微信图床
-                r'xlink:href=["\']([^"\'>]*(?:mmbiz\.qpic\.cn|mmecoa\.qpic\.cn)[^"\'>]*)["\']',  # xlink:href中的微信图床
-                
-                # 其他常见图床URL（如oss.e2.cool等）
-                r'src=["\']([^"\'>]*oss\.e2\.cool[^"\'>]*)["\']',
-                r'href=["\']([^"\'>]*oss\.e2\.cool[^"\'>]*)["\']',
-                r'url\(["\']?([^"\')>]*oss\.e2\.cool[^"\')>]*)["\']?\)',
-                r'background-image:[^;]*url\(["\']?([^"\')>]*oss\.e2\.cool[^"\')>]*)["\']?\)',
-                r'xlink:href=["\']([^"\'>]*oss\.e2\.cool[^"\'>]*)["\']',
-            ]
-            
             urls = set()
-            for pattern in patterns:
-                matches = re.findall(pattern, decoded_content, re.IGNORECASE)
-                for match in matches:
-                    if isinstance(match, tuple):
-                        url = match[0]
-                    else:
-                        url = match
-                    
-                    # 验证URL格式
-                    if self._is_valid_url(url):
-                        urls.add(url)
+            for match in _SVG_IMAGE_URL_RE.finditer(decoded_content):
+                url = match.group(1) or match.group(2)
+                
+                # 验证URL格式
+                if self._is_valid_url(url):
+                    urls.add(url)
             
             logger.info(f"从SVG代码中提取到 {len(urls)} 个图片URL")
             return list(urls)
@@ -78,7 +85,28 @@ class ImageAnalyzer:
             return False
     
     def get_image_size(self, url: str) -> Tuple[int, str]:
-        """获取图片大小（字节）和格式化大小字符串"""
+        """获取图片大小（字节）和格式化大小字符串，结果按URL缓存"""
+        now = time.monotonic()
+        with self._size_cache_lock:
+            cached = self._size_cache.get(url)
+            if cached and cached[0] > now:
+                self._size_cache.move_to_end(url)
+                return cached[1]
+        
+        size_bytes, size_str = self._fetch_image_size(url)
+        
+        # 只缓存成功获取的大小，失败或未知的结果下次重新请求
+        if size_bytes > 0:
+            with self._size_cache_lock:
+                self._size_cache[url] = (now + config.IMAGE_SIZE_CACHE_TTL, (size_bytes, size_str))
+                self._size_cache.move_to_end(url)
+                while len(self._size_cache) > config.IMAGE_SIZE_CACHE_MAXSIZE:
+                    self._size_cache.popitem(last=False)
+        
+        return size_bytes, size_str
+    
+    def _fetch_image_size(self, url: str) -> Tuple[int, str]:
+        """通过网络请求获取图片大小"""
         try:
             # 为微信图片设置特殊的请求头，解决防盗链问题
             headers = self.session.headers.copy()
@@ -101,27 +129,23 @@ class ImageAnalyzer:
                     size_str = self._format_size(size_bytes)
                     return size_bytes, size_str
             
-            # 如果HEAD请求失败，尝试GET请求（只获取部分内容）
-            response = self.session.get(url, headers=headers, timeout=10, stream=True)
-            if response.status_code == 200:
-                content_length = response.headers.get('Content-Length')
-                if content_length:
-                    size_bytes = int(content_length)
-                    size_str = self._format_size(size_bytes)
-                    return size_bytes, size_str
+            # 如果HEAD请求失败，发送只请求首字节的Range GET，从Content-Range中读取总大小
+            range_headers = dict(headers, Range='bytes=0-0')
+            with self.session.get(url, headers=range_headers, timeout=10, stream=True) as response:
+                if response.status_code == 206:
+                    content_range = response.headers.get('Content-Range', '')
+                    total = content_range.rsplit('/', 1)[-1]
+                    if total.isdigit():
+                        size_bytes = int(total)
+                        return size_bytes, self._format_size(size_bytes)
                 
-                # 如果没有Content-Length，下载部分内容估算
-                chunk_size = 1024 * 1024  # 1MB
-                downloaded = 0
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    downloaded += len(chunk)
-                    if downloaded >= chunk_size:
-                        break
-                
-                # 估算总大小（这只是一个粗略估计）
-                estimated_size = downloaded
-                size_str = f"~{self._format_size(estimated_size)}"
-                return estimated_size, size_str
+                elif response.status_code == 200:
+                    # 服务器忽略了Range时只信任Content-Length，不再下载内容估算
+                    content_length = response.headers.get('Content-Length')
+                    if content_length:
+                        size_bytes = int(content_length)
+                        size_str = self._format_size(size_bytes)
+                        return size_bytes, size_str
             
             return 0, "未知"
             
@@ -131,21 +155,13 @@ class ImageAnalyzer:
     
     def _format_size(self, size_bytes: int) -> str:
         """格式化文件大小"""
-        if size_bytes == 0:
-            return "0 B"
-        
-        units = ['B', 'KB', 'MB', 'GB']
-        size = float(size_bytes)
-        unit_index = 0
-        
-        while size >= 1024 and unit_index < len(units) - 1:
-            size /= 1024
-            unit_index += 1
+        if size_bytes < 1024:
+            return f"{int(size_bytes)} B"
         
-        if unit_index == 0:
-            return f"{int(size)} {units[unit_index]}"
-        else:
-            return f"{size:.2f} {units[unit_index]}"
+        # bit_length直接算出1024的幂次，无需循环除法
+        unit_index = min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+        size = size_bytes / (1 << (unit_index * 10))
+        return f"{size:.2f} {_SIZE_UNITS[unit_index]}"
     
     def is_large_image(self, size_bytes: int) -> bool:
         """判断图片是否过大（超过3MB）"""
@@ -202,18 +218,24 @@ class ImageAnalyzer:
             logger.warning(f"获取图片尺寸失败 {url}: {str(e)}")
             return None
     
+    def _probe_image(self, url: str) -> Tuple[int, str, Optional[Tuple[int, int]]]:
+        """获取单张图片的大小和尺寸"""
+        logger.info(f"分析图片: {url}")
+        size_bytes, size_str = self.get_image_size(url)
+        dimensions = self.get_image_dimensions(url)
+        return size_bytes, size_str, dimensions
+    
     def analyze_svg_images(self, svg_content: str) -> List[Dict]:
         """分析SVG中的所有图片"""
         try:
             urls = self.extract_image_urls_from_svg(svg_content)
             results = []
             
-            for i, url in enumerate(urls, 1):
-                logger.info(f"分析图片 {i}/{len(urls)}: {url}")
-                
-                size_bytes, size_str = self.get_image_size(url)
-                dimensions = self.get_image_dimensions(url)
-                
+            # 图片大小和尺寸的探测都是网络I/O，使用线程池并发执行
+            with ThreadPoolExecutor(max_workers=config.ANALYZE_MAX_WORKERS) as executor:
+                probes = list(executor.map(self._probe_image, urls))
+            
+            for i, (url, (size_bytes, size_str, dimensions)) in enumerate(zip(urls, probes), 1):
                 # 判断是否超过3MB
                 is_large = size_bytes > 3 * 1024 * 1024  # 3MB
                 
@@ -263,43 +285,15 @@ class ImageAnalyzer:
                 logger.info(f"HTML编码URL替换成功: {html_encoded_url}")
                 return updated_content
             
-            # 检查HTML实体编码格式：url(&quot;URL&quot;);
-            html_entity_pattern = f"&quot;{old_url}&quot;"
-            if html_entity_pattern in svg_content:
-                updated_content = svg_content.replace(html_entity_pattern, f"&quot;{new_url}&quot;")
-                logger.info(f"HTML实体格式替换成功: {html_entity_pattern}")
-                return updated_content
-            
-            # 检查HTML实体编码格式（带HTML编码的&符号）
-            html_entity_encoded_pattern = f"&quot;{html_encoded_url}&quot;"
-            if html_entity_encoded_pattern in svg_content:
-                new_html_encoded_url = new_url.replace('&', '&amp;')
-                updated_content = svg_content.replace(html_entity_encoded_pattern, f"&quot;{new_html_encoded_url}&quot;")
-                logger.info(f"HTML实体编码格式替换成功: {html_entity_encoded_pattern}")
-                return updated_content
-            
-            # 检查公众号特殊格式：url(&quot; `URL&quot;);` 
-            wechat_pattern = f"&quot; `{old_url}&quot;);` "
-            if wechat_pattern in svg_content:
-                updated_content = svg_content.replace(wechat_pattern, f"&quot; `{new_url}&quot;);` ")
-                logger.info(f"微信公众号格式替换成功: {wechat_pattern}")
-                return updated_content
-            
-            # 检查是否有反引号包围的URL格式
-            backtick_pattern = f"`{old_url}`"
-            if backtick_pattern in svg_content:
-                updated_content = svg_content.replace(backtick_pattern, f"`{new_url}`")
-                logger.info(f"反引号格式替换成功: {backtick_pattern}")
-                return updated_content
-            
-            # 检查复杂的HTML实体编码格式：url(&quot; `URL` &quot;);
-            complex_pattern = f"&quot; `{old_url}` &quot;"
-            if complex_pattern in svg_content:
-                updated_content = svg_content.replace(complex_pattern, f"&quot; `{new_url}` &quot;")
-                logger.info(f"复杂HTML实体格式替换成功: {complex_pattern}")
-                return updated_content
+            # 以下格式（&quot;包裹、反引号包裹、公众号格式等）都包含原始URL或其编码形式，
+            # 已被上面的直接替换覆盖；剩下只可能是大小写不同的写法，先做一次廉价的预检
+            svg_lower = svg_content.lower()
+            if old_url.lower() not in svg_lower and html_encoded_url.lower() not in svg_lower:
+                logger.warning(f"未找到要替换的URL: {old_url}")
+                logger.warning(f"SVG内容前500字符: {svg_content[:500]}")
+                return svg_content
             
-            # 如果直接替换失败，尝试正则表达式替换
+            # 直接替换失败，使用忽略大小写的正则表达式替换
             # 转义特殊字符
             escaped_old_url = re.escape(old_url)
             escaped_html_encoded_url = re.escape(html_encoded_url)
@@ -324,26 +318,21 @@ class ImageAnalyzer:
                 (rf'url\(&quot;({escaped_html_encoded_url})&quot;\)', f'url(&quot;{new_url.replace("&", "&amp;")}&quot;)'),
             ]
             
-            updated_content = svg_content
-            replaced_count = 0
-            
-            for pattern, replacement in patterns:
-                new_content = re.sub(pattern, replacement, updated_content, flags=re.IGNORECASE)
-                if new_content != updated_content:
-                    replaced_count += 1
-                    updated_content = new_content
-                    logger.info(f"正则表达式替换成功，模式: {pattern}")
+            # 合并为一个带命名分组的正则，只扫描一遍内容；回调按命中的分组返回字面替换值
+            combined = re.compile(
+                '|'.join(f'(?P<p{i}>{pattern})' for i, (pattern, _) in enumerate(patterns)),
+                re.IGNORECASE
+            )
+            updated_content, replaced_count = combined.subn(
+                lambda m: patterns[int(m.lastgroup[1:])][1], svg_content
+            )
             
             if replaced_count > 0:
-                logger.info(f"成功替换URL: {old_url} -> {new_url}")
+                logger.info(f"正则表达式替换成功，共替换 {replaced_count} 处: {old_url} -> {new_url}")
             else:
                 logger.warning(f"未找到要替换的URL: {old_url}")
                 # 输出调试信息
                 logger.warning(f"SVG内容前500字符: {svg_content[:500]}")
-                # 输出所有尝试的模式
-                logger.warning(f"尝试的HTML实体模式: {html_entity_pattern}")
-                logger.warning(f"尝试的HTML编码模式: {html_entity_encoded_pattern}")
-                logger.warning(f"尝试的微信公众号模式: {wechat_pattern}")
             
             return updated_content
             
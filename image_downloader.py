@@ -3,19 +3,65 @@
 图片下载模块
 """
 
+import io
 import os
+import json
+import shutil
+import hashlib
 import time
+import random
+import threading
+import mmap
+import atexit
 import logging
 from typing import List, Dict, Optional, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, DecodeError, ReadTimeoutError, SSLError
 from PIL import Image
 from tqdm import tqdm
 
 import config
-from utils import get_filename_from_url, sanitize_filename, format_file_size
+from utils import (get_filename_from_url, sanitize_filename, format_file_size, detect_image_format,
+                   is_valid_image_magic, is_retryable_error)
+
+
+# 进程内共享的下载会话，所有下载器实例与重试复用同一个连接池（keep-alive）
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+})
+# 每个主机的连接池大小随默认并发数增长，突发请求也能复用已有连接
+_adapter = HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=max(64, config.DEFAULT_DOWNLOAD_CONCURRENCY * 2),
+    max_retries=0,
+    pool_block=False
+)
+_SESSION.mount('http://', _adapter)
+_SESSION.mount('https://', _adapter)
+atexit.register(_SESSION.close)
+
+# 不支持HEAD请求（如返回405）的主机，预检时跳过
+_head_unsupported_hosts = set()
+
+# 每个主机的并发下载限制，避免同时向同一个CDN发出过多请求
+_host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_host_semaphores_lock = threading.Lock()
+
+
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    """获取URL所属主机的并发信号量"""
+    host = urlparse(url).netloc
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(config.DOWNLOAD_PER_HOST_LIMIT)
+            _host_semaphores[host] = semaphore
+        return semaphore
 
 
 class ImageDownloader:
@@ -23,13 +69,24 @@ class ImageDownloader:
     
     def __init__(self):
         self.logger = logging.getLogger(__name__)
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
+        self.session = _SESSION
         
-        # 创建下载目录
+        # 创建下载目录和缓存目录
         os.makedirs(config.DOWNLOAD_DIR, exist_ok=True)
+        os.makedirs(config.CACHE_DIR, exist_ok=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
+    def close(self):
+        """关闭会话中的空闲连接
+        
+        会话在进程内共享，关闭后仍可继续使用（会重新建立连接），进程退出时也会通过atexit自动关闭。
+        """
+        self.session.close()
     
     def download_single_image(self, url: str, custom_filename: Optional[str] = None) -> Dict:
         """下载单张图片
@@ -50,73 +107,13 @@ class ImageDownloader:
         }
         
         try:
-            # 获取文件名
-            if custom_filename:
-                filename = custom_filename
-            else:
-                filename = get_filename_from_url(url)
-            
-            filename = sanitize_filename(filename)
-            local_path = os.path.join(config.DOWNLOAD_DIR, filename)
-            
-            # 如果文件已存在，添加序号
-            counter = 1
-            original_path = local_path
-            while os.path.exists(local_path):
-                name, ext = os.path.splitext(original_path)
-                local_path = f"{name}_{counter}{ext}"
-                counter += 1
-            
-            # 下载图片
-            self.logger.info(f"开始下载图片: {url}")
-            
-            response = self.session.get(
-                url, 
-                timeout=config.REQUEST_TIMEOUT,
-                stream=True
-            )
-            response.raise_for_status()
-            
-            # 检查内容类型
-            content_type = response.headers.get('content-type', '').lower()
-            if not content_type.startswith('image/'):
-                raise ValueError(f"URL返回的不是图片内容: {content_type}")
-            
-            # 检查文件大小
-            content_length = response.headers.get('content-length')
-            if content_length and int(content_length) > config.MAX_IMAGE_SIZE:
-                raise ValueError(f"图片文件过大: {format_file_size(int(content_length))}")
-            
-            # 保存文件
-            total_size = 0
-            with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        total_size += len(chunk)
-                        
-                        # 检查下载过程中的文件大小
-                        if total_size > config.MAX_IMAGE_SIZE:
-                            f.close()
-                            os.remove(local_path)
-                            raise ValueError(f"图片文件过大: {format_file_size(total_size)}")
-            
-            # 验证图片文件
-            try:
-                with Image.open(local_path) as img:
-                    img.verify()
-            except Exception as e:
-                os.remove(local_path)
-                raise ValueError(f"图片文件损坏或格式不支持: {str(e)}")
-            
+            local_path, total_size = self._call_with_retries(self._download, url, custom_filename)
             result.update({
                 'success': True,
                 'local_path': local_path,
                 'file_size': total_size
             })
             
-            self.logger.info(f"图片下载成功: {url} -> {local_path} ({format_file_size(total_size)})")
-            
         except requests.exceptions.RequestException as e:
             error_msg = f"网络请求错误: {str(e)}"
             result['error'] = error_msg
@@ -133,12 +130,409 @@ class ImageDownloader:
         
         return result
     
-    def download_images_batch(self, urls: List[str], max_workers: int = 5) -> List[Dict]:
+    def download_to_bytes(self, url: str) -> Tuple[bytes, str]:
+        """下载图片到内存，不写入磁盘
+        
+        Args:
+            url: 图片URL
+            
+        Returns:
+            (图片内容, 文件名)
+            
+        Raises:
+            requests.exceptions.RequestException: 网络请求失败
+            ValueError: 内容不是图片、图片过大或图片损坏
+        """
+        filename = sanitize_filename(get_filename_from_url(url))
+        
+        cache_path = self._cache_path(url)
+        if os.path.isfile(cache_path) and not config.CACHE_REVALIDATE:
+            self.logger.info(f"命中图片缓存，跳过下载: {url}")
+            with open(cache_path, 'rb') as f:
+                return f.read(), filename
+        
+        data = self._call_with_retries(self._fetch_bytes, url)
+        return data, filename
+    
+    def _fetch_bytes(self, url: str) -> bytes:
+        """执行一次下载到内存的尝试"""
+        self.logger.info(f"开始下载图片到内存: {url}")
+        
+        self._preflight(url)
+        
+        with self.session.get(url, timeout=config.REQUEST_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            
+            # 读取内容之前先根据响应头检查类型和大小
+            self._check_headers(response)
+            
+            # MAX_IMAGE_SIZE同时限制了内存占用
+            buf = io.BytesIO()
+            total_size = 0
+            for chunk in self._iter_raw(response):
+                total_size += len(chunk)
+                if total_size > config.MAX_IMAGE_SIZE:
+                    raise ValueError(f"图片文件过大: {format_file_size(total_size)}")
+                buf.write(chunk)
+        
+        # 验证图片数据
+        if not detect_image_format(buf.getbuffer()[:32]):
+            raise ValueError("图片文件损坏或格式不支持: 文件头不是支持的图片格式")
+        
+        if config.STRICT_IMAGE_VERIFY:
+            try:
+                buf.seek(0)
+                with Image.open(buf) as img:
+                    img.verify()
+            except Exception as e:
+                raise ValueError(f"图片文件损坏或格式不支持: {str(e)}")
+        
+        self.logger.info(f"图片下载成功: {url} ({format_file_size(total_size)})")
+        
+        return buf.getvalue()
+    
+    def _check_headers(self, response: requests.Response, existing_size: int = 0):
+        """根据响应头检查内容类型和文件大小，不符合时关闭响应并抛出ValueError
+        
+        Args:
+            response: 尚未读取内容的流式响应
+            existing_size: 续传时本地已有的字节数
+        """
+        # 检查内容类型
+        content_type = response.headers.get('content-type', '').lower()
+        if not content_type.startswith('image/'):
+            response.close()
+            raise ValueError(f"URL返回的不是图片内容: {content_type}")
+        
+        # 检查文件大小
+        content_length = response.headers.get('content-length')
+        if content_length:
+            expected_size = int(content_length) + existing_size
+            if expected_size > config.MAX_IMAGE_SIZE:
+                response.close()
+                raise ValueError(f"图片文件过大: {format_file_size(expected_size)}")
+    
+    def _preflight(self, url: str):
+        """下载前发送HEAD请求，根据响应头提前排除非图片和过大的文件
+        
+        不支持HEAD或不返回有效响应头的主机会被记录下来，之后不再对其发送HEAD请求。
+        HEAD请求本身失败时不影响后续下载。
+        """
+        if not config.DOWNLOAD_HEAD_PREFLIGHT:
+            return
+        
+        host = urlparse(url).netloc
+        if host in _head_unsupported_hosts:
+            return
+        
+        try:
+            with self.session.head(url, timeout=config.HEAD_PREFLIGHT_TIMEOUT, allow_redirects=True) as response:
+                if response.status_code != 200 or 'content-type' not in response.headers:
+                    _head_unsupported_hosts.add(host)
+                    return
+                self._check_headers(response)
+        except requests.exceptions.RequestException:
+            return
+    
+    def _iter_raw(self, response: requests.Response):
+        """从响应的原始流中逐块读取数据
+        
+        复用同一个预分配缓冲区，通过readinto直接读入，避免iter_content每块都创建新的bytes对象。
+        返回的memoryview在读取下一块时会被覆盖，调用方需要立即写出。
+        读取中途的urllib3异常与iter_content一样转换为requests异常，以便按网络错误重试。
+        """
+        raw = response.raw
+        raw.decode_content = True
+        view = memoryview(bytearray(64 * 1024))
+        while True:
+            try:
+                n = raw.readinto(view)
+            except ProtocolError as e:
+                raise requests.exceptions.ChunkedEncodingError(e)
+            except DecodeError as e:
+                raise requests.exceptions.ContentDecodingError(e)
+            except ReadTimeoutError as e:
+                raise requests.exceptions.ConnectionError(e)
+            except SSLError as e:
+                raise requests.exceptions.SSLError(e)
+            if not n:
+                break
+            yield view[:n]
+    
+    def _call_with_retries(self, func, url: str, *args):
+        """调用单次下载函数，失败时按带随机抖动的指数退避重试
+        
+        每个URL在自己的任务内独立重试，不必等待整批完成后再统一重试。
+        """
+        semaphore = _host_semaphore(url)
+        for attempt in range(config.MAX_RETRIES + 1):
+            try:
+                # 只在请求期间占用主机名额，退避等待时释放
+                with semaphore:
+                    return func(url, *args)
+            except requests.exceptions.RequestException as e:
+                if attempt >= config.MAX_RETRIES or not is_retryable_error(e):
+                    raise
+                
+                delay = 2 ** attempt + random.random()
+                self.logger.warning(f"下载失败，{delay:.1f}秒后进行第 {attempt + 1} 次重试 {url}: {str(e)}")
+                time.sleep(delay)
+    
+    def _download(self, url: str, custom_filename: Optional[str] = None) -> Tuple[str, int]:
+        """执行一次下载尝试
+        
+        图片按URL哈希保存在缓存目录中，下载目录中的文件是指向缓存的硬链接，
+        再次运行时缓存命中即可跳过下载。
+        
+        Returns:
+            (本地文件路径, 文件大小)
+        """
+        # 获取文件名
+        if custom_filename:
+            filename = custom_filename
+        else:
+            filename = get_filename_from_url(url)
+        
+        filename = sanitize_filename(filename)
+        local_path = os.path.join(config.DOWNLOAD_DIR, filename)
+        
+        cache_path = self._cache_path(url)
+        if os.path.isfile(cache_path) and not config.CACHE_REVALIDATE:
+            total_size = os.path.getsize(cache_path)
+            self.logger.info(f"命中图片缓存，跳过下载: {url}")
+        else:
+            total_size = self._fetch_to_cache(url, cache_path)
+        
+        local_path = self._link_unique(cache_path, local_path)
+        
+        self.logger.info(f"图片下载成功: {url} -> {local_path} ({format_file_size(total_size)})")
+        
+        return local_path, total_size
+    
+    def _cache_path(self, url: str) -> str:
+        """获取URL对应的缓存文件路径（按URL的SHA-256哈希命名）"""
+        cache_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        ext = os.path.splitext(get_filename_from_url(url))[1].lower() or '.jpg'
+        return os.path.join(config.CACHE_DIR, cache_key + ext)
+    
+    def _fetch_to_cache(self, url: str, cache_path: str) -> int:
+        """下载图片到缓存目录
+        
+        先写入.tmp文件，验证通过后再重命名为正式的缓存文件，缓存中不会出现不完整的图片。
+        支持断点续传（.tmp文件）和条件请求（已缓存的文件）。
+        
+        Returns:
+            文件大小
+        """
+        tmp_path = f"{cache_path}.tmp"
+        
+        # 读取上次下载留下的元数据，用于条件请求和断点续传
+        cached_meta = self._load_meta(cache_path, url)
+        partial_meta = self._load_meta(tmp_path, url)
+        existing_size = os.path.getsize(tmp_path) if partial_meta else 0
+        
+        headers = {}
+        if cached_meta:
+            # 已完整下载过，文件未变化时服务器返回304
+            if cached_meta.get('etag'):
+                headers['If-None-Match'] = cached_meta['etag']
+            if cached_meta.get('last_modified'):
+                headers['If-Modified-Since'] = cached_meta['last_modified']
+        elif existing_size > 0:
+            validator = partial_meta.get('etag') or partial_meta.get('last_modified')
+            if validator:
+                # 上次下载中断，只请求剩余部分；资源已变化时服务器会返回完整内容
+                headers['Range'] = f"bytes={existing_size}-"
+                headers['If-Range'] = validator
+        
+        if not headers:
+            # 全新下载时，先用HEAD请求排除非图片和过大的文件
+            self._preflight(url)
+        
+        # 下载图片
+        self.logger.info(f"开始下载图片: {url}")
+        
+        response = self.session.get(
+            url, 
+            headers=headers,
+            timeout=config.REQUEST_TIMEOUT,
+            stream=True
+        )
+        
+        if response.status_code == 304:
+            response.close()
+            self.logger.info(f"图片未变化，使用缓存: {url}")
+            return os.path.getsize(cache_path)
+        
+        if response.status_code == 416:
+            # 续传范围无效，重新完整下载
+            response.close()
+            response = self.session.get(url, timeout=config.REQUEST_TIMEOUT, stream=True)
+        
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        resuming = response.status_code == 206
+        
+        # 读取内容之前先根据响应头检查类型和大小，不符合时直接关闭连接
+        self._check_headers(response, existing_size if resuming else 0)
+        
+        # 保存文件，同时把内容写入内存缓冲区，下载完后直接在内存中验证
+        if resuming:
+            # 续传时内存中只有后半部分，改为下载后通过mmap验证
+            f = open(tmp_path, 'ab', buffering=256 * 1024)
+            total_size = existing_size
+            buf = None
+        else:
+            f = open(tmp_path, 'wb', buffering=256 * 1024)
+            total_size = 0
+            buf = io.BytesIO() if config.STRICT_IMAGE_VERIFY else None
+        
+        self._save_meta(tmp_path, url, response, complete=False)
+        
+        with f, response:
+            for chunk in self._iter_raw(response):
+                f.write(chunk)
+                total_size += len(chunk)
+                
+                # 检查下载过程中的文件大小
+                if total_size > config.MAX_IMAGE_SIZE:
+                    f.close()
+                    self._remove_download(tmp_path)
+                    raise ValueError(f"图片文件过大: {format_file_size(total_size)}")
+                
+                if buf is not None:
+                    if total_size <= config.INLINE_VERIFY_MAX_SIZE:
+                        buf.write(chunk)
+                    else:
+                        # 超过阈值不再缓存，改为下载后通过mmap验证
+                        buf = None
+        
+        # 验证图片文件：默认只检查文件头，严格模式下再用PIL完整校验
+        if not is_valid_image_magic(tmp_path):
+            self._remove_download(tmp_path)
+            raise ValueError("图片文件损坏或格式不支持: 文件头不是支持的图片格式")
+        
+        if config.STRICT_IMAGE_VERIFY:
+            try:
+                if buf is not None:
+                    buf.seek(0)
+                    with Image.open(buf) as img:
+                        img.verify()
+                else:
+                    # 通过mmap直接从页缓存取数据，避免逐块read系统调用
+                    # （mmap不允许越界seek，PIL探测格式时会越界，所以包一层BytesIO）
+                    with open(tmp_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        with Image.open(io.BytesIO(mm)) as img:
+                            img.verify()
+            except Exception as e:
+                self._remove_download(tmp_path)
+                raise ValueError(f"图片文件损坏或格式不支持: {str(e)}")
+        
+        # 验证通过后原子地放入缓存
+        os.replace(tmp_path, cache_path)
+        self._save_meta(cache_path, url, response, complete=True)
+        self._remove_download(self._meta_path(tmp_path))
+        
+        return total_size
+    
+    def _link_unique(self, cache_path: str, local_path: str) -> str:
+        """把缓存文件硬链接到下载目录，文件名冲突时添加序号
+        
+        已经链接过的同一文件直接复用；文件系统不支持硬链接时退回复制。
+        
+        Returns:
+            实际文件路径
+        """
+        name, ext = os.path.splitext(local_path)
+        candidate = local_path
+        counter = 1
+        while True:
+            try:
+                os.link(cache_path, candidate)
+                return candidate
+            except FileExistsError:
+                if os.path.samefile(candidate, cache_path):
+                    return candidate
+                candidate = f"{name}_{counter}{ext}"
+                counter += 1
+            except OSError:
+                break
+        
+        f, candidate = self._open_unique(local_path)
+        with f, open(cache_path, 'rb') as src:
+            shutil.copyfileobj(src, f, 256 * 1024)
+        return candidate
+    
+    def _meta_path(self, local_path: str) -> str:
+        """获取下载元数据文件路径"""
+        return f"{local_path}.meta.json"
+    
+    def _load_meta(self, local_path: str, url: str) -> Optional[Dict]:
+        """读取同一URL上次下载留下的元数据
+        
+        Returns:
+            元数据字典；文件不存在或属于其他URL时返回None
+        """
+        if not os.path.exists(local_path):
+            return None
+        
+        try:
+            with open(self._meta_path(local_path), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        
+        return meta if meta.get('url') == url else None
+    
+    def _save_meta(self, local_path: str, url: str, response: requests.Response, complete: bool):
+        """保存ETag/Last-Modified等元数据，供续传和条件请求使用"""
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'complete': complete
+        }
+        with open(self._meta_path(local_path), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+    
+    def _remove_download(self, local_path: str):
+        """删除下载文件及其元数据"""
+        for path in (local_path, self._meta_path(local_path)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    def _open_unique(self, local_path: str) -> Tuple[io.BufferedWriter, str]:
+        """以独占方式创建文件，文件已存在时添加序号
+        
+        由O_EXCL让内核保证原子性，并发下载同名文件时不会选到同一个序号。
+        
+        Args:
+            local_path: 期望的文件路径
+            
+        Returns:
+            (已打开的文件对象, 实际文件路径)
+        """
+        name, ext = os.path.splitext(local_path)
+        candidate = local_path
+        counter = 1
+        while True:
+            try:
+                fd = os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                candidate = f"{name}_{counter}{ext}"
+                counter += 1
+                continue
+            return os.fdopen(fd, 'wb', buffering=256 * 1024), candidate
+    
+    def download_images_batch(self, urls: List[str], max_workers: Optional[int] = None) -> List[Dict]:
         """批量下载图片
         
         Args:
             urls: 图片URL列表
-            max_workers: 最大并发数
+            max_workers: 最大并发数，默认使用config.DEFAULT_DOWNLOAD_CONCURRENCY
             
         Returns:
             下载结果列表
@@ -148,24 +542,30 @@ class ImageDownloader:
         
         self.logger.info(f"开始批量下载 {len(urls)} 张图片")
         
+        max_workers = max_workers or config.DEFAULT_DOWNLOAD_CONCURRENCY
         results = []
         
-        # 使用线程池并发下载
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 使用线程池并发下载，线程数不超过任务数
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
             # 提交所有下载任务
-            future_to_url = {executor.submit(self.download_single_image, url): url for url in urls}
+            futures = [executor.submit(self.download_single_image, url) for url in urls]
             
-            # 使用进度条显示下载进度
-            with tqdm(total=len(urls), desc="下载图片", unit="张") as pbar:
-                for future in as_completed(future_to_url):
+            # 使用进度条显示下载进度，限制重绘频率，避免大量小图片时刷新进度条占用CPU
+            with tqdm(total=len(urls), desc="下载图片", unit="张",
+                      mininterval=0.1, miniters=max(1, len(urls) // 200)) as pbar:
+                last_postfix = 0.0
+                for future in as_completed(futures):
                     result = future.result()
                     results.append(result)
                     
-                    # 更新进度条
-                    if result['success']:
-                        pbar.set_postfix(status="成功", file=os.path.basename(result['local_path']))
-                    else:
-                        pbar.set_postfix(status="失败", error=result['error'][:30])
+                    # 更新进度条，状态信息最多每0.1秒刷新一次
+                    now = time.monotonic()
+                    if now - last_postfix > 0.1:
+                        if result['success']:
+                            pbar.set_postfix(status="成功", file=os.path.basename(result['local_path']), refresh=False)
+                        else:
+                            pbar.set_postfix(status="失败", error=result['error'][:30], refresh=False)
+                        last_postfix = now
                     
                     pbar.update(1)
         
@@ -178,46 +578,6 @@ class ImageDownloader:
         
         return results
     
-    def retry_failed_downloads(self, failed_results: List[Dict], max_retries: int = None) -> List[Dict]:
-        """重试失败的下载
-        
-        Args:
-            failed_results: 失败的下载结果列表
-            max_retries: 最大重试次数
-            
-        Returns:
-            重试结果列表
-        """
-        if max_retries is None:
-            max_retries = config.MAX_RETRIES
-        
-        failed_urls = [r['url'] for r in failed_results if not r['success']]
-        if not failed_urls:
-            return []
-        
-        self.logger.info(f"开始重试 {len(failed_urls)} 个失败的下载")
-        
-        retry_results = []
-        
-        for attempt in range(max_retries):
-            if not failed_urls:
-                break
-            
-            self.logger.info(f"第 {attempt + 1} 次重试，剩余 {len(failed_urls)} 个")
-            
-            # 重试下载
-            current_results = self.download_images_batch(failed_urls)
-            retry_results.extend(current_results)
-            
-            # 更新失败列表
-            failed_urls = [r['url'] for r in current_results if not r['success']]
-            
-            # 如果还有失败的，等待一段时间再重试
-            if failed_urls and attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # 指数退避
-        
-        return retry_results
-    
     def cleanup_downloads(self, keep_successful: bool = True):
         """清理下载目录
         
@@ -228,22 +588,18 @@ class ImageDownloader:
             return
         
         if not keep_successful:
-            import shutil
             shutil.rmtree(config.DOWNLOAD_DIR)
             os.makedirs(config.DOWNLOAD_DIR, exist_ok=True)
             self.logger.info("已清理所有下载文件")
         else:
-            # 只清理可能的临时文件
-            for filename in os.listdir(config.DOWNLOAD_DIR):
-                if filename.startswith('temp_') or filename.endswith('.tmp'):
-                    filepath = os.path.join(config.DOWNLOAD_DIR, filename)
-                    try:
-                        os.remove(filepath)
-                        self.logger.info(f"清理临时文件: {filename}")
-                    except Exception as e:
-                        self.logger.warning(f"清理文件失败 {filename}: {str(e)}")
-    
-    def __del__(self):
-        """析构函数，关闭会话"""
-        if hasattr(self, 'session'):
-            self.session.close()
\ No newline at end of file
+            # 只清理可能的临时文件，缓存目录中未完成的下载留给断点续传使用
+            with os.scandir(config.DOWNLOAD_DIR) as it:
+                for entry in it:
+                    if entry.name.startswith('temp_') or entry.name.endswith('.tmp'):
+                        try:
+                            os.unlink(entry.path)
+                            self.logger.info(f"清理临时文件: {entry.name}")
+                        except FileNotFoundError:
+                            pass
+                        except Exception as e:
+                            self.logger.warning(f"清理文件失败 {entry.name}: {str(e)}")
@@ -12,10 +12,9 @@
 
 import os
 import sys
-import json
 import argparse
-from pathlib import Path
 from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 from colorama import init, Fore, Style
@@ -25,7 +24,7 @@ from tqdm import tqdm
 init()
 
 # 导入自定义模块
-from utils import setup_logging, create_directories
+from utils import setup_logging, create_directories, group_duplicate_urls, save_json, save_text, load_json
 from document_processor import DocumentProcessor
 from image_downloader import ImageDownloader
 from wechat_uploader import WeChatUploader
@@ -97,12 +96,12 @@ class ImageReplacementTool:
             self.logger.error(f"路径不存在: {source_path}")
             return []
     
-    def download_images(self, image_urls: List[str], max_workers: int = 5) -> Dict[str, str]:
+    def download_images(self, image_urls: List[str], max_workers: Optional[int] = None) -> Dict[str, str]:
         """下载图片并返回URL到本地路径的映射
         
         Args:
             image_urls: 图片URL列表
-            max_workers: 最大并发数
+            max_workers: 最大并发数，默认使用config.DEFAULT_DOWNLOAD_CONCURRENCY
             
         Returns:
             URL到本地路径的映射字典
@@ -111,23 +110,19 @@ class ImageReplacementTool:
             self.logger.warning("没有图片URL需要下载")
             return {}
         
-        self.logger.info(f"开始下载 {len(image_urls)} 张图片")
+        # 相同或等价的URL只下载一次，结果再分发给所有写法
+        url_groups = group_duplicate_urls(image_urls)
+        self.logger.info(f"开始下载 {len(url_groups)} 张图片（共 {len(image_urls)} 个URL）")
         
-        # 批量下载
-        results = self.downloader.download_images_batch(image_urls, max_workers)
-        
-        # 重试失败的下载
-        failed_results = [r for r in results if not r['success']]
-        if failed_results:
-            self.logger.info(f"重试 {len(failed_results)} 个失败的下载")
-            retry_results = self.downloader.retry_failed_downloads(failed_results)
-            results.extend(retry_results)
+        # 批量下载（失败的请求在各自的下载任务内重试）
+        results = self.downloader.download_images_batch(list(url_groups), max_workers)
         
         # 创建URL到本地路径的映射
         url_to_path = {}
         for result in results:
             if result['success']:
-                url_to_path[result['url']] = result['local_path']
+                for url in url_groups[result['url']]:
+                    url_to_path[url] = result['local_path']
         
         successful_count = len(url_to_path)
         self.logger.info(f"图片下载完成: 成功 {successful_count}/{len(image_urls)} 张")
@@ -153,16 +148,9 @@ class ImageReplacementTool:
         
         self.logger.info(f"开始上传 {len(local_paths)} 张图片到微信公众号")
         
-        # 批量上传
+        # 批量上传，每张图片的重试在上传器内部完成
         results = self.uploader.upload_images_batch(local_paths, permanent)
         
-        # 重试失败的上传
-        failed_results = [r for r in results if not r['success']]
-        if failed_results:
-            self.logger.info(f"重试 {len(failed_results)} 个失败的上传")
-            retry_results = self.uploader.retry_failed_uploads(failed_results, permanent)
-            results.extend(retry_results)
-        
         # 创建本地路径到微信URL的映射
         path_to_wechat_url = {}
         for result in results:
@@ -175,6 +163,127 @@ class ImageReplacementTool:
         
         return path_to_wechat_url
     
+    def download_and_upload_pipelined(self, image_urls: List[str], max_workers: Optional[int] = None,
+                                      permanent: bool = True) -> Dict[str, str]:
+        """流水线方式下载并上传图片：每张图片下载完成后立即提交上传，下载与上传同时进行
+        
+        Args:
+            image_urls: 图片URL列表
+            max_workers: 最大下载并发数，默认使用config.DEFAULT_DOWNLOAD_CONCURRENCY
+            permanent: 是否上传为永久素材
+            
+        Returns:
+            原始URL到微信URL的映射字典
+        """
+        if not self.uploader:
+            raise ValueError("微信上传器未初始化")
+        
+        if not image_urls:
+            self.logger.warning("没有图片URL需要下载")
+            return {}
+        
+        # 相同或等价的URL只处理一次，结果再分发给所有写法
+        url_groups = group_duplicate_urls(image_urls)
+        self.logger.info(f"开始下载并上传 {len(url_groups)} 张图片（共 {len(image_urls)} 个URL）")
+        
+        max_workers = max_workers or config.DEFAULT_DOWNLOAD_CONCURRENCY
+        download_pool = ThreadPoolExecutor(max_workers=min(max_workers, len(url_groups)))
+        # 上传与批量上传使用相同的并发数，请求频率由上传器的限速器控制
+        upload_pool = ThreadPoolExecutor(max_workers=config.UPLOAD_CONCURRENCY)
+        upload_futures = {}
+        downloaded = 0
+        
+        with download_pool, upload_pool:
+            download_futures = [download_pool.submit(self.downloader.download_single_image, url) for url in url_groups]
+            
+            with tqdm(total=len(url_groups), desc="下载图片", unit="张") as pbar:
+                for future in as_completed(download_futures):
+                    result = future.result()
+                    if result['success']:
+                        downloaded += 1
+                        upload_future = upload_pool.submit(self.uploader.upload, result['local_path'], permanent)
+                        upload_futures[upload_future] = result['url']
+                    pbar.update(1)
+            
+            upload_results = []
+            url_by_path = {}
+            for upload_future in as_completed(upload_futures):
+                upload_result = upload_future.result()
+                upload_results.append(upload_result)
+                url_by_path[upload_result['local_path']] = upload_futures[upload_future]
+        
+        self.logger.info(f"图片下载完成: 成功 {downloaded}/{len(url_groups)} 张")
+        
+        # 创建原始URL到微信URL的映射
+        url_mapping = {}
+        for result in upload_results:
+            if result['success']:
+                wechat_url = result.get('media_url') or f"https://mmbiz.qpic.cn/mmbiz_jpg/{result['media_id']}/0"
+                for url in url_groups[url_by_path[result['local_path']]]:
+                    url_mapping[url] = wechat_url
+        
+        self.logger.info(f"图片上传完成: 共 {len(url_mapping)}/{len(image_urls)} 个URL完成转存")
+        
+        return url_mapping
+    
+    def transfer_images_in_memory(self, image_urls: List[str], max_workers: Optional[int] = None,
+                                  permanent: bool = True) -> Dict[str, str]:
+        """下载图片到内存后直接上传到微信公众号，不在本地保存文件
+        
+        Args:
+            image_urls: 图片URL列表
+            max_workers: 最大下载并发数，默认使用config.DEFAULT_DOWNLOAD_CONCURRENCY
+            permanent: 是否上传为永久素材
+            
+        Returns:
+            原始URL到微信URL的映射字典
+        """
+        if not self.uploader:
+            raise ValueError("微信上传器未初始化")
+        
+        if not image_urls:
+            self.logger.warning("没有图片URL需要处理")
+            return {}
+        
+        # 相同或等价的URL只处理一次，结果再分发给所有写法
+        url_groups = group_duplicate_urls(image_urls)
+        self.logger.info(f"开始以内存方式转存 {len(url_groups)} 张图片（共 {len(image_urls)} 个URL）")
+        
+        max_workers = max_workers or config.DEFAULT_DOWNLOAD_CONCURRENCY
+        url_mapping = {}
+        download_pool = ThreadPoolExecutor(max_workers=min(max_workers, len(url_groups)))
+        upload_pool = ThreadPoolExecutor(max_workers=config.UPLOAD_CONCURRENCY)
+        upload_futures = {}
+        
+        # 并发下载，下载完成的图片立即提交到上传线程池并发上传
+        with download_pool, upload_pool:
+            future_to_url = {download_pool.submit(self.downloader.download_to_bytes, url): url for url in url_groups}
+            
+            with tqdm(total=len(url_groups), desc="转存图片", unit="张") as pbar:
+                for future in as_completed(future_to_url):
+                    url = future_to_url[future]
+                    try:
+                        data, filename = future.result()
+                    except Exception as e:
+                        self.logger.error(f"下载失败 {url}: {str(e)}")
+                        pbar.update(1)
+                        continue
+                    
+                    upload_future = upload_pool.submit(self.uploader.upload_bytes, data, filename, permanent)
+                    upload_futures[upload_future] = url
+                    pbar.update(1)
+            
+            for upload_future in as_completed(upload_futures):
+                result = upload_future.result()
+                if result['success']:
+                    wechat_url = result.get('media_url') or f"https://mmbiz.qpic.cn/mmbiz_jpg/{result['media_id']}/0"
+                    for original_url in url_groups[upload_futures[upload_future]]:
+                        url_mapping[original_url] = wechat_url
+        
+        self.logger.info(f"图片转存完成: 共 {len(url_mapping)}/{len(image_urls)} 个URL完成转存")
+        
+        return url_mapping
+    
     def replace_urls_in_documents(self, source_path: str, url_mapping: Dict[str, str],
                                 output_path: str = None, backup: bool = True) -> List[Dict]:
         """替换文档中的图片URL
@@ -209,8 +318,9 @@ class ImageReplacementTool:
     
     def run_complete_workflow(self, source_path: str, output_path: str = None,
                             appid: str = None, secret: str = None,
-                            max_workers: int = 5, backup: bool = True,
-                            permanent: bool = True, save_mapping: bool = True) -> bool:
+                            max_workers: Optional[int] = None, backup: bool = True,
+                            permanent: bool = True, save_mapping: bool = True,
+                            keep_local: bool = True) -> bool:
         """运行完整的工作流程
         
         Args:
@@ -218,10 +328,11 @@ class ImageReplacementTool:
             output_path: 输出路径
             appid: 微信公众号AppID
             secret: 微信公众号AppSecret
-            max_workers: 最大并发数
+            max_workers: 最大并发数，默认使用config.DEFAULT_DOWNLOAD_CONCURRENCY
             backup: 是否备份原文件
             permanent: 是否上传为永久素材
             save_mapping: 是否保存URL映射
+            keep_local: 是否在本地保存下载的图片，为False时图片只经过内存
             
         Returns:
             是否成功完成
@@ -240,32 +351,24 @@ class ImageReplacementTool:
             
             click.echo(f"{Fore.GREEN}找到 {len(image_urls)} 个图片URL{Style.RESET_ALL}")
             
-            # 3. 下载图片
-            click.echo(f"{Fore.CYAN}步骤 2/5: 下载图片...{Style.RESET_ALL}")
-            url_to_path = self.download_images(image_urls, max_workers)
-            if not url_to_path:
-                click.echo(f"{Fore.RED}没有成功下载任何图片{Style.RESET_ALL}")
-                return False
-            
-            # 4. 上传到微信公众号
-            click.echo(f"{Fore.CYAN}步骤 3/5: 上传到微信公众号...{Style.RESET_ALL}")
-            local_paths = list(url_to_path.values())
-            path_to_wechat_url = self.upload_images_to_wechat(local_paths, permanent)
-            if not path_to_wechat_url:
-                click.echo(f"{Fore.RED}没有成功上传任何图片{Style.RESET_ALL}")
-                return False
-            
-            # 5. 创建URL映射
-            click.echo(f"{Fore.CYAN}步骤 4/5: 创建URL映射...{Style.RESET_ALL}")
-            url_mapping = {}
-            for original_url, local_path in url_to_path.items():
-                if local_path in path_to_wechat_url:
-                    url_mapping[original_url] = path_to_wechat_url[local_path]
+            if keep_local:
+                # 3-5. 下载图片并上传到微信公众号（下载完成的图片立即开始上传）
+                click.echo(f"{Fore.CYAN}步骤 2-4/5: 下载并上传到微信公众号...{Style.RESET_ALL}")
+                url_mapping = self.download_and_upload_pipelined(image_urls, max_workers, permanent)
+                if not url_mapping:
+                    click.echo(f"{Fore.RED}没有成功上传任何图片{Style.RESET_ALL}")
+                    return False
+            else:
+                # 3-5. 下载到内存后直接上传，不保存本地文件
+                click.echo(f"{Fore.CYAN}步骤 2-4/5: 下载并上传到微信公众号（不保存本地文件）...{Style.RESET_ALL}")
+                url_mapping = self.transfer_images_in_memory(image_urls, max_workers, permanent)
+                if not url_mapping:
+                    click.echo(f"{Fore.RED}没有成功上传任何图片{Style.RESET_ALL}")
+                    return False
             
             if save_mapping:
                 mapping_file = 'url_mapping.json'
-                with open(mapping_file, 'w', encoding='utf-8') as f:
-                    json.dump(url_mapping, f, ensure_ascii=False, indent=2)
+                save_json(mapping_file, url_mapping)
                 click.echo(f"{Fore.GREEN}URL映射已保存到: {mapping_file}{Style.RESET_ALL}")
             
             # 6. 替换文档中的URL
@@ -278,8 +381,7 @@ class ImageReplacementTool:
             
             # 保存报告
             report_file = 'replacement_report.txt'
-            with open(report_file, 'w', encoding='utf-8') as f:
-                f.write(report)
+            save_text(report_file, report)
             click.echo(f"{Fore.GREEN}详细报告已保存到: {report_file}{Style.RESET_ALL}")
             
             click.echo(f"{Fore.GREEN}\n✅ 工作流程完成！{Style.RESET_ALL}")
@@ -304,11 +406,12 @@ def cli():
 @click.option('--output', '-o', help='输出路径')
 @click.option('--appid', help='微信公众号AppID')
 @click.option('--secret', help='微信公众号AppSecret')
-@click.option('--workers', '-w', default=5, help='最大并发数')
+@click.option('--workers', '-w', type=int, default=None, help='最大并发数（默认根据CPU核数计算，可用IMGTOOL_CONCURRENCY环境变量设置）')
 @click.option('--no-backup', is_flag=True, help='不备份原文件')
 @click.option('--temporary', is_flag=True, help='上传为临时素材')
 @click.option('--no-save-mapping', is_flag=True, help='不保存URL映射')
-def run(source_path, output, appid, secret, workers, no_backup, temporary, no_save_mapping):
+@click.option('--no-keep-local', is_flag=True, help='不在本地保存图片，下载后直接从内存上传')
+def run(source_path, output, appid, secret, workers, no_backup, temporary, no_save_mapping, no_keep_local):
     """运行完整的图片地址替换流程"""
     tool = ImageReplacementTool()
     
@@ -320,7 +423,8 @@ def run(source_path, output, appid, secret, workers, no_backup, temporary, no_sa
         max_workers=workers,
         backup=not no_backup,
         permanent=not temporary,
-        save_mapping=not no_save_mapping
+        save_mapping=not no_save_mapping,
+        keep_local=not no_keep_local
     )
     
     sys.exit(0 if success else 1)
@@ -341,9 +445,7 @@ def extract(source_path):
         
         # 保存到文件
         output_file = 'extracted_urls.txt'
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for url in image_urls:
-                f.write(url + '\n')
+        save_text(output_file, ''.join(url + '\n' for url in image_urls))
         click.echo(f"{Fore.GREEN}\nURL列表已保存到: {output_file}{Style.RESET_ALL}")
     else:
         click.echo(f"{Fore.YELLOW}没有找到图片URL{Style.RESET_ALL}")
@@ -351,7 +453,7 @@ def extract(source_path):
 
 @cli.command()
 @click.argument('urls_file', type=click.Path(exists=True))
-@click.option('--workers', '-w', default=5, help='最大并发数')
+@click.option('--workers', '-w', type=int, default=None, help='最大并发数（默认根据CPU核数计算，可用IMGTOOL_CONCURRENCY环境变量设置）')
 def download(urls_file, workers):
     """从文件中读取URL并下载图片"""
     tool = ImageReplacementTool()
@@ -372,8 +474,7 @@ def download(urls_file, workers):
         
         # 保存映射
         mapping_file = 'download_mapping.json'
-        with open(mapping_file, 'w', encoding='utf-8') as f:
-            json.dump(url_to_path, f, ensure_ascii=False, indent=2)
+        save_json(mapping_file, url_to_path)
         click.echo(f"{Fore.GREEN}下载映射已保存到: {mapping_file}{Style.RESET_ALL}")
     else:
         click.echo(f"{Fore.RED}没有成功下载任何图片{Style.RESET_ALL}")
@@ -392,13 +493,13 @@ def upload(images_dir, appid, secret, temporary):
         click.echo(f"{Fore.RED}微信上传器初始化失败{Style.RESET_ALL}")
         return
     
-    # 获取图片文件列表
-    image_files = []
-    for ext in config.SUPPORTED_FORMATS:
-        pattern = f"*{ext}"
-        image_files.extend(Path(images_dir).glob(pattern))
-    
-    local_paths = [str(p) for p in image_files]
+    # 获取图片文件列表（只遍历一次目录）
+    exts = {ext.lower() for ext in config.SUPPORTED_FORMATS}
+    with os.scandir(images_dir) as it:
+        local_paths = [
+            entry.path for entry in it
+            if entry.is_file(follow_symlinks=False) and os.path.splitext(entry.name)[1].lower() in exts
+        ]
     
     if not local_paths:
         click.echo(f"{Fore.YELLOW}目录中没有找到图片文件{Style.RESET_ALL}")
@@ -412,8 +513,7 @@ def upload(images_dir, appid, secret, temporary):
         
         # 保存映射
         mapping_file = 'upload_mapping.json'
-        with open(mapping_file, 'w', encoding='utf-8') as f:
-            json.dump(path_to_wechat_url, f, ensure_ascii=False, indent=2)
+        save_json(mapping_file, path_to_wechat_url)
         click.echo(f"{Fore.GREEN}上传映射已保存到: {mapping_file}{Style.RESET_ALL}")
     else:
         click.echo(f"{Fore.RED}没有成功上传任何图片{Style.RESET_ALL}")
@@ -429,8 +529,7 @@ def replace(source_path, mapping_file, output, no_backup):
     tool = ImageReplacementTool()
     
     # 读取URL映射
-    with open(mapping_file, 'r', encoding='utf-8') as f:
-        url_mapping = json.load(f)
+    url_mapping = load_json(mapping_file)
     
     if not url_mapping:
         click.echo(f"{Fore.YELLOW}映射文件为空{Style.RESET_ALL}")
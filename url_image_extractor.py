@@ -6,23 +6,48 @@
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import re
 from urllib.parse import urljoin, urlparse
-from PIL import Image
-import io
+from PIL import ImageFile
 import os
-import logging
-from typing import List, Dict, Optional
-from bs4 import BeautifulSoup
-import hashlib
 import time
+import logging
+import threading
+import zipfile
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import lxml.etree
+import lxml.html
+
+import config
+from utils import short_hash, RateLimiter
 
 logger = logging.getLogger(__name__)
 
+# 文件大小单位，依次为1024的0~4次幂
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+# 本身已经压缩过的图片格式
+_COMPRESSED_IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+# 页面中的微信公众号图片URL
+_WECHAT_IMG_URL_RE = re.compile(r'https://mmbiz\.qpic\.cn/[^\s"\'>]+', re.IGNORECASE)
+
+
+def _zip_compress_type(filename: str) -> int:
+    """已压缩的图片格式在压缩包中直接存储，再次压缩几乎不会变小，只会浪费CPU"""
+    if filename.lower().endswith(_COMPRESSED_IMAGE_EXTS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
 class URLImageExtractor:
     """URL图片抓取器"""
     
-    def __init__(self, download_folder='downloads'):
+    def __init__(self, download_folder='downloads', rate_per_host: Optional[float] = None):
         self.download_folder = download_folder
         os.makedirs(download_folder, exist_ok=True)
         
@@ -30,49 +55,90 @@ class URLImageExtractor:
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
+        
+        # 所有请求复用同一个会话，同一主机的图片共享keep-alive连接；
+        # 连接池大小随并发获取信息的线程数增长，并发请求不会因连接池已满而丢弃连接
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(64, config.PROBE_MAX_WORKERS * 2),
+            pool_block=False
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # 每个图片主机一个限速器，只限制同一主机的请求速度，不同主机互不影响
+        self.rate_per_host = rate_per_host or config.EXTRACTOR_RATE_PER_HOST
+        self._host_limiters: Dict[str, RateLimiter] = {}
+        self._host_limiters_lock = threading.Lock()
+        
+        # 获取图片信息时下载的内容，供随后的下载直接使用，过期后释放
+        self._body_cache: OrderedDict = OrderedDict()
+        self._body_cache_bytes = 0
+        self._body_cache_lock = threading.Lock()
     
     def extract_images_from_url(self, url: str) -> List[Dict]:
         """从URL抓取所有图片信息"""
         try:
             logger.info(f"开始抓取URL: {url}")
             
+            # 释放之前抓取时暂存、已经过期的图片内容
+            with self._body_cache_lock:
+                self._purge_expired_bodies()
+            
             # 获取网页内容
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self.session.get(url, timeout=10)
             response.raise_for_status()
             
-            # 解析HTML
-            soup = BeautifulSoup(response.content, 'html.parser')
+            # 解析HTML（lxml为C实现，比BeautifulSoup的html.parser快得多）
+            try:
+                img_tags = list(lxml.html.fromstring(response.content).iter('img'))
+            except lxml.etree.ParserError:
+                # 页面为空（空白或仅含注释），没有img标签
+                img_tags = []
             
             images = []
             processed_urls = set()  # 避免重复
             
-            # 方法1: 查找所有图片标签
-            img_tags = soup.find_all('img')
-            for i, img in enumerate(img_tags):
-                img_info = self._process_image_tag(img, url, i)
+            # 方法1: 查找所有图片标签，并发获取图片信息
+            with ThreadPoolExecutor(max_workers=config.PROBE_MAX_WORKERS) as executor:
+                tag_infos = list(executor.map(
+                    lambda pair: self._process_image_tag(pair[1], url, pair[0]),
+                    enumerate(img_tags)
+                ))
+            for img_info in tag_infos:
                 if img_info and img_info['url'] not in processed_urls and img_info['url'].startswith('https://mmbiz.qpic.cn/'):
                     images.append(img_info)
                     processed_urls.add(img_info['url'])
             
             # 方法2: 使用正则表达式匹配页面中的微信公众号图片URL
             # 只抓取 https://mmbiz.qpic.cn/ 开头的图片
-            img_url_pattern = r'https://mmbiz\.qpic\.cn/[^\s"\'>]+'
-            found_urls = set(re.findall(img_url_pattern, response.text, re.IGNORECASE))
-            
-            for i, img_url in enumerate(found_urls):
-                if img_url not in processed_urls and img_url.startswith('https://mmbiz.qpic.cn/'):
-                    # 跳过base64和SVG
-                    if img_url.startswith('data:') or img_url.endswith('.svg'):
-                        continue
-                    
-                    try:
-                        img_info = self._get_image_info(img_url, len(images))
-                        if img_info:
-                            images.append(img_info)
-                            processed_urls.add(img_url)
-                    except Exception as e:
-                        logger.warning(f"处理正则匹配的图片URL失败: {img_url}, 错误: {str(e)}")
-                        continue
+            found_urls = set(_WECHAT_IMG_URL_RE.findall(response.text))
+            
+            # 跳过已处理的URL以及base64和SVG
+            pending_urls = [
+                img_url for img_url in found_urls
+                if img_url not in processed_urls and img_url.startswith('https://mmbiz.qpic.cn/')
+                and not (img_url.startswith('data:') or img_url.endswith('.svg'))
+            ]
+            
+            if pending_urls:
+                start = len(images)
+                with ThreadPoolExecutor(max_workers=min(config.PROBE_MAX_WORKERS, len(pending_urls))) as executor:
+                    futures = [
+                        executor.submit(self._get_image_info, img_url, start + i)
+                        for i, img_url in enumerate(pending_urls)
+                    ]
+                    for img_url, future in zip(pending_urls, futures):
+                        try:
+                            img_info = future.result()
+                            if img_info:
+                                images.append(img_info)
+                                processed_urls.add(img_url)
+                        except Exception as e:
+                            logger.warning(f"处理正则匹配的图片URL失败: {img_url}, 错误: {str(e)}")
+                            continue
             
             logger.info(f"成功抓取到 {len(images)} 张图片 (img标签: {len(img_tags)}, 正则匹配: {len(found_urls)})")
             return images
@@ -84,6 +150,16 @@ class URLImageExtractor:
             logger.error(f"抓取图片失败: {str(e)}")
             raise Exception(f"抓取失败: {str(e)}")
     
+    def _limiter_for(self, url: str) -> RateLimiter:
+        """获取URL所属主机的限速器"""
+        host = urlparse(url).netloc
+        with self._host_limiters_lock:
+            limiter = self._host_limiters.get(host)
+            if limiter is None:
+                limiter = RateLimiter(self.rate_per_host)
+                self._host_limiters[host] = limiter
+            return limiter
+    
     def _process_image_tag(self, img_tag, base_url: str, index: int) -> Optional[Dict]:
         """处理单个图片标签"""
         try:
@@ -116,71 +192,86 @@ class URLImageExtractor:
             return None
     
     def _get_image_info(self, img_url: str, index: int) -> Dict:
-        """获取图片详细信息"""
+        """获取图片详细信息
+        
+        只发送一次带Range的流式GET请求，PIL解析图片头得到尺寸后即停止读取，不解码像素。
+        服务器不支持Range而返回完整内容时，不太大的内容暂存起来供download_image使用，不再重复请求。
+        """
         try:
-            # 发送HEAD请求获取基本信息
-            head_response = requests.head(img_url, headers=self.headers, timeout=5)
-            
-            # 如果HEAD请求失败，尝试GET请求
-            if head_response.status_code != 200:
-                response = requests.get(img_url, headers=self.headers, timeout=10, stream=True)
+            self._limiter_for(img_url).acquire()
+            with self.session.get(img_url, headers={'Range': f'bytes=0-{config.IMAGE_PROBE_RANGE_BYTES - 1}'},
+                                  timeout=10, stream=True) as response:
                 response.raise_for_status()
-            else:
-                response = head_response
-            
-            # 获取文件大小
-            content_length = response.headers.get('content-length')
-            file_size = int(content_length) if content_length else 0
-            
-            # 获取文件类型
-            content_type = response.headers.get('content-type', '')
-            
-            # 生成唯一ID
-            img_id = hashlib.md5(f"{img_url}_{index}".encode()).hexdigest()[:8]
-            
-            img_info = {
-                'id': img_id,
-                'url': img_url,
-                'size_bytes': file_size,
-                'size_formatted': self._format_file_size(file_size),
-                'content_type': content_type,
-                'width': 0,
-                'height': 0,
-                'dimensions': '未知',
-                'downloaded': False,
-                'local_path': None
-            }
-            
-            # 尝试获取图片尺寸（需要下载部分内容）
-            try:
-                if head_response.status_code == 200:
-                    # 重新发送GET请求获取图片内容
-                    img_response = requests.get(img_url, headers=self.headers, timeout=10)
-                    img_response.raise_for_status()
+                partial = response.status_code == 206
+                
+                # 获取文件大小，部分响应时从Content-Range中取总大小
+                if partial:
+                    total = response.headers.get('content-range', '').rpartition('/')[2]
+                    file_size = int(total) if total.isdigit() else 0
                 else:
-                    img_response = response
+                    content_length = response.headers.get('content-length')
+                    file_size = int(content_length) if content_length else 0
                 
-                # 使用PIL获取图片尺寸
-                img_data = io.BytesIO(img_response.content)
-                with Image.open(img_data) as pil_img:
-                    width, height = pil_img.size
-                    img_info.update({
-                        'width': width,
-                        'height': height,
-                        'dimensions': f'{width} × {height}',
-                        'size_bytes': len(img_response.content)  # 更准确的文件大小
-                    })
-                    img_info['size_formatted'] = self._format_file_size(img_info['size_bytes'])
-                    
-            except Exception as e:
-                logger.warning(f"获取图片尺寸失败: {str(e)}")
+                # 获取文件类型
+                content_type = response.headers.get('content-type', '')
+                
+                # 生成唯一ID
+                img_id = short_hash(f"{img_url}_{index}")
+                
+                img_info = {
+                    'id': img_id,
+                    'url': img_url,
+                    'size_bytes': file_size,
+                    'size_formatted': self._format_file_size(file_size),
+                    'content_type': content_type,
+                    'width': 0,
+                    'height': 0,
+                    'dimensions': '未知',
+                    'downloaded': False,
+                    'local_path': None
+                }
+                
+                # 边接收边用PIL增量解析图片头获取尺寸
+                parser = ImageFile.Parser()
+                # 完整内容超过暂存上限时不再保留，之后与部分响应一样只读取到能解析出尺寸为止
+                body = None if partial else bytearray()
+                for chunk in response.iter_content(chunk_size=8192):
+                    if body is not None:
+                        if len(body) + len(chunk) > config.EXTRACTOR_BODY_CACHE_ENTRY_MAX_BYTES:
+                            body = None
+                        else:
+                            body.extend(chunk)
+                    if parser.image is None:
+                        try:
+                            parser.feed(chunk)
+                        except Exception:
+                            pass
+                    if body is None and parser.image is not None:
+                        # 已经拿到尺寸，剩余部分不再读取
+                        break
+            
+            if body is not None:
+                content = bytes(body)
+                img_info['size_bytes'] = len(content)  # 更准确的文件大小
+                img_info['size_formatted'] = self._format_file_size(img_info['size_bytes'])
+                self._cache_body(img_url, content_type, content)
+            
+            if parser.image is not None:
+                width, height = parser.image.size
+                img_info.update({
+                    'width': width,
+                    'height': height,
+                    'dimensions': f'{width} × {height}'
+                })
+            else:
+                logger.warning(f"获取图片尺寸失败: 无法解析图片 {img_url}")
             
             return img_info
             
         except Exception as e:
             logger.warning(f"获取图片信息失败: {str(e)}")
             # 返回基本信息
-            img_id = hashlib.md5(f"{img_url}_{index}".encode()).hexdigest()[:8]
+            img_id = short_hash(f"{img_url}_{index}")
             return {
                 'id': img_id,
                 'url': img_url,
@@ -194,51 +285,103 @@ class URLImageExtractor:
                 'local_path': None
             }
     
+    def _cache_body(self, img_url: str, content_type: str, content: bytes):
+        """暂存获取信息时下载的图片内容，总大小超过上限时淘汰最早的条目"""
+        with self._body_cache_lock:
+            self._purge_expired_bodies()
+            old = self._body_cache.pop(img_url, None)
+            if old:
+                self._body_cache_bytes -= len(old[1])
+            self._body_cache[img_url] = (content_type, content, time.monotonic() + config.EXTRACTOR_BODY_CACHE_TTL)
+            self._body_cache_bytes += len(content)
+            while self._body_cache_bytes > config.EXTRACTOR_BODY_CACHE_MAX_BYTES:
+                _, (_, evicted, _) = self._body_cache.popitem(last=False)
+                self._body_cache_bytes -= len(evicted)
+    
+    def _purge_expired_bodies(self):
+        """释放已过期的暂存内容，调用方需持有_body_cache_lock
+        
+        有效期相同，条目按加入顺序过期，只需从最早的条目开始检查。
+        """
+        now = time.monotonic()
+        while self._body_cache:
+            _, (_, content, expires_at) = next(iter(self._body_cache.items()))
+            if expires_at > now:
+                break
+            self._body_cache.popitem(last=False)
+            self._body_cache_bytes -= len(content)
+    
+    def _pop_cached_body(self, img_url: str) -> Optional[Tuple[str, bytes]]:
+        """取出暂存的图片内容，没有或已过期时返回None"""
+        with self._body_cache_lock:
+            self._purge_expired_bodies()
+            cached = self._body_cache.pop(img_url, None)
+            if not cached:
+                return None
+            self._body_cache_bytes -= len(cached[1])
+            return cached[0], cached[1]
+    
+    def _fetch_image(self, img_url: str) -> Tuple[str, bytes]:
+        """获取图片内容，获取信息时已经下载过的图片直接使用暂存的内容
+        
+        Returns:
+            (内容类型, 图片内容)
+        """
+        cached = self._pop_cached_body(img_url)
+        if cached:
+            return cached
+        
+        # 发送请求下载图片
+        self._limiter_for(img_url).acquire()
+        response = self.session.get(img_url, timeout=30)
+        response.raise_for_status()
+        return response.headers.get('content-type', ''), response.content
+    
+    def _image_filename(self, img_info: Dict, content_type: str) -> str:
+        """根据内容类型（或URL）确定扩展名，生成图片文件名"""
+        # 确定文件扩展名
+        if 'jpeg' in content_type or 'jpg' in content_type:
+            ext = '.jpg'
+        elif 'png' in content_type:
+            ext = '.png'
+        elif 'gif' in content_type:
+            ext = '.gif'
+        elif 'webp' in content_type:
+            ext = '.webp'
+        else:
+            # 从URL推断扩展名
+            parsed_url = urlparse(img_info['url'])
+            path = parsed_url.path.lower()
+            if path.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')):
+                ext = os.path.splitext(path)[1]
+            else:
+                ext = '.jpg'  # 默认扩展名
+        
+        return f"image_{img_info['id']}{ext}"
+    
     def download_image(self, img_info: Dict) -> Dict:
         """下载单张图片"""
         try:
             img_url = img_info['url']
-            img_id = img_info['id']
             
             logger.info(f"开始下载图片: {img_url}")
             
-            # 发送请求下载图片
-            response = requests.get(img_url, headers=self.headers, timeout=30)
-            response.raise_for_status()
-            
-            # 确定文件扩展名
-            content_type = response.headers.get('content-type', '')
-            if 'jpeg' in content_type or 'jpg' in content_type:
-                ext = '.jpg'
-            elif 'png' in content_type:
-                ext = '.png'
-            elif 'gif' in content_type:
-                ext = '.gif'
-            elif 'webp' in content_type:
-                ext = '.webp'
-            else:
-                # 从URL推断扩展名
-                parsed_url = urlparse(img_url)
-                path = parsed_url.path.lower()
-                if path.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')):
-                    ext = os.path.splitext(path)[1]
-                else:
-                    ext = '.jpg'  # 默认扩展名
+            content_type, content = self._fetch_image(img_url)
             
             # 生成文件名
-            filename = f"image_{img_id}{ext}"
+            filename = self._image_filename(img_info, content_type)
             local_path = os.path.join(self.download_folder, filename)
             
             # 保存文件
             with open(local_path, 'wb') as f:
-                f.write(response.content)
+                f.write(content)
             
             # 更新图片信息
             img_info.update({
                 'downloaded': True,
                 'local_path': local_path,
                 'filename': filename,
-                'size_bytes': len(response.content)
+                'size_bytes': len(content)
             })
             img_info['size_formatted'] = self._format_file_size(img_info['size_bytes'])
             
@@ -249,76 +392,95 @@ class URLImageExtractor:
             logger.error(f"下载图片失败: {str(e)}")
             raise Exception(f"下载失败: {str(e)}")
     
-    def download_all_images(self, images: List[Dict]) -> List[Dict]:
-        """批量下载所有图片"""
-        downloaded_images = []
+    def download_all_images(self, images: List[Dict], max_workers: Optional[int] = None) -> List[Dict]:
+        """批量并发下载所有图片，结果顺序与输入一致
         
-        for img_info in images:
-            try:
-                downloaded_img = self.download_image(img_info.copy())
-                downloaded_images.append(downloaded_img)
-                time.sleep(0.5)  # 避免请求过于频繁
-            except Exception as e:
-                logger.warning(f"跳过下载失败的图片: {img_info['url']} - {str(e)}")
-                img_info['download_error'] = str(e)
-                downloaded_images.append(img_info)
+        抓取的图片都来自同一个图片主机，并发数默认不超过config.DOWNLOAD_PER_HOST_LIMIT，
+        代替原来每张图片之间的固定等待。
+        """
+        if not images:
+            return []
         
-        return downloaded_images
+        max_workers = min(max_workers or config.DOWNLOAD_PER_HOST_LIMIT, len(images))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self._download_or_mark, images))
+    
+    def _download_or_mark(self, img_info: Dict) -> Dict:
+        """下载单张图片，失败时在图片信息中记录错误而不是抛出异常"""
+        try:
+            return self.download_image(img_info.copy())
+        except Exception as e:
+            logger.warning(f"跳过下载失败的图片: {img_info['url']} - {str(e)}")
+            img_info['download_error'] = str(e)
+            return img_info
     
     def _format_file_size(self, size_bytes: int) -> str:
         """格式化文件大小"""
         if size_bytes == 0:
             return "未知"
         
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.1f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.1f} TB"
+        # bit_length直接算出1024的幂次，无需循环除法
+        unit_index = min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+        return f"{size_bytes / (1 << (unit_index * 10)):.1f} {_SIZE_UNITS[unit_index]}"
+    
+    def _fetch_for_archive(self, img_info: Dict) -> Optional[Tuple[str, bytes]]:
+        """获取要写入压缩包的图片内容，失败时返回None
+        
+        Returns:
+            (压缩包中的文件名, 图片内容)
+        """
+        try:
+            content_type, content = self._fetch_image(img_info['url'])
+            return self._image_filename(img_info, content_type), content
+        except Exception as e:
+            logger.warning(f"下载图片失败: {img_info['url']} - {str(e)}")
+            return None
     
     def create_download_archive(self, images: List[Dict]) -> Dict:
         """创建下载压缩包"""
-        import zipfile
         from datetime import datetime
         
         try:
             # 确保下载目录存在
             os.makedirs(self.download_folder, exist_ok=True)
             
-            # 先下载所有图片
-            downloaded_images = []
-            for img_info in images:
-                if not img_info.get('downloaded'):
-                    try:
-                        download_result = self.download_image(img_info.copy())
-                        downloaded_images.append(download_result)
-                    except Exception as e:
-                        logger.warning(f"下载图片失败: {img_info['url']} - {str(e)}")
-                        img_info['download_error'] = str(e)
-                        downloaded_images.append(img_info)
-                else:
-                    downloaded_images.append(img_info)
-            
             # 生成压缩包文件名
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             archive_name = f"images_{timestamp}.zip"
             archive_path = os.path.join(self.download_folder, archive_name)
             
-            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for img_info in downloaded_images:
+            pending = [img_info for img_info in images if not img_info.get('downloaded')]
+            
+            downloaded_count = 0
+            # 图片格式本身已经压缩，直接存储；其他文件使用最快的压缩级别
+            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+                for img_info in images:
                     if img_info.get('downloaded') and img_info.get('local_path'):
                         local_path = img_info['local_path']
                         if os.path.exists(local_path):
                             # 使用原始文件名或生成的文件名
                             arcname = img_info.get('filename', os.path.basename(local_path))
-                            zipf.write(local_path, arcname)
+                            zipf.write(local_path, arcname, compress_type=_zip_compress_type(arcname))
+                            downloaded_count += 1
+                
+                # 尚未下载的图片并发获取内容，每张获取完成后立即写入压缩包并释放，不在内存中积累所有图片
+                if pending:
+                    with ThreadPoolExecutor(max_workers=min(config.DOWNLOAD_PER_HOST_LIMIT, len(pending))) as executor:
+                        futures = {executor.submit(self._fetch_for_archive, img_info) for img_info in pending}
+                        for future in as_completed(futures):
+                            futures.discard(future)
+                            item = future.result()
+                            if item:
+                                arcname, content = item
+                                zipf.writestr(arcname, content, compress_type=_zip_compress_type(arcname))
+                                downloaded_count += 1
             
             logger.info(f"创建压缩包成功: {archive_name}")
             return {
                 'success': True,
                 'archive_name': archive_name,
                 'archive_path': archive_path,
-                'downloaded_count': len([img for img in downloaded_images if img.get('downloaded')])
+                'downloaded_count': downloaded_count
             }
             
         except Exception as e:
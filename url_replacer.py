@@ -5,19 +5,179 @@ URL替换模块
 
 import os
 import re
+import mmap
+import codecs
 import logging
 import shutil
-from typing import Dict, List, Optional
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from urllib.parse import urlsplit
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 from bs4 import BeautifulSoup
 
+import config
+from utils import setup_worker_logging
+
+
+# 需要替换URL的文档扩展名
+_REPLACE_EXTS = frozenset(('.txt', '.md', '.html', '.htm'))
+
+# 读取文档时依次尝试的编码
+_DECODE_ENCODINGS = ('utf-8', 'gbk', 'gb2312', 'latin1')
+
+# 映射中的主机数不超过该值时，先按主机名预筛选文件
+_PREFILTER_MAX_HOSTS = 16
+
+
+def _trie_to_regex(node: Dict) -> str:
+    """把前缀树转换为正则表达式，公共前缀只出现一次
+    
+    只有一个分支的连续节点合并为一段字面量，嵌套深度只与分叉次数有关。
+    键''表示有URL在该节点结束。
+    """
+    branches = []
+    for char in sorted(key for key in node if key):
+        run = char
+        child = node[char]
+        while len(child) == 1 and '' not in child:
+            (next_char, child), = child.items()
+            run += next_char
+        branches.append(re.escape(run) + _trie_to_regex(child))
+    
+    if not branches:
+        return ''
+    
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        # 较短的URL在此结束，贪婪匹配优先尝试更长的URL
+        return '(?:' + body + ')?'
+    return body
+
+
+def _build_url_pattern(urls) -> re.Pattern:
+    """把一组URL编译为基于前缀树的正则
+    
+    普通的多选正则在每个位置都要逐个尝试所有URL，URL大多有相同的前缀（如同一个CDN），
+    映射很大时非常慢；前缀树形式的正则在每个位置只沿一条路径匹配，总是匹配最长的URL。
+    """
+    trie = {}
+    for url in urls:
+        node = trie
+        for char in url:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return re.compile(_trie_to_regex(trie))
+
+
+def _is_utf8(data) -> bool:
+    """分块校验字节数据是否为合法的UTF-8，不生成完整的解码字符串"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunk_size = 1 << 20
+    try:
+        for start in range(0, len(data), chunk_size):
+            decoder.decode(data[start:start + chunk_size])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _host_needles(urls) -> Optional[Tuple[bytes, ...]]:
+    """提取一组URL的主机名，作为预筛选文件内容的字节串
+    
+    文件中不包含任何一个主机名时，也不可能包含其中的URL。
+    有URL没有主机名、主机名不是ASCII（在GBK等编码下字节不同）或主机过多时返回None，不做预筛选。
+    """
+    hosts = set()
+    for url in urls:
+        try:
+            host = urlsplit(url).netloc
+        except ValueError:
+            return None
+        if not host or not host.isascii():
+            return None
+        hosts.add(host)
+    
+    if len(hosts) > _PREFILTER_MAX_HOSTS:
+        return None
+    return tuple(host.encode('ascii') for host in sorted(hosts))
+
+
+def _iter_target_files(directory_path: str, recursive: bool):
+    """遍历目录中需要替换URL的文档文件
+    
+    基于os.scandir，直接使用目录项自带的类型信息，不为每个文件创建Path对象；
+    递归时不进入指向目录的符号链接。
+    """
+    stack = [directory_path]
+    while stack:
+        current = stack.pop()
+        subdirs = []
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        subdirs.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in _REPLACE_EXTS and entry.is_file():
+                    yield entry.path
+        # 倒序入栈，子目录按列出的顺序处理
+        stack.extend(reversed(subdirs))
+
 
 class URLReplacer:
     """URL替换器"""
     
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        
+        # (映射快照, 由映射中所有原始URL编译成的正则, 预筛选用的主机名)，映射不变时复用
+        self._compiled = None
+        # (字符串版本的匹配器, 对应的字节版本)，用于内存映射的大文件
+        self._bytes_compiled = None
+    
+    def _get_matcher(self, url_mapping: Dict[str, str]) -> Optional[Tuple[re.Pattern, Dict[str, str]]]:
+        """获取匹配映射中任意原始URL的正则，以及匹配文本到新URL的查找表
+        
+        含&的URL在HTML中通常写作&amp;，查找表同时包含这种写法，替换结果也保持转义。
+        同一位置优先匹配最长的URL。映射中没有有效URL时返回None。
+        """
+        compiled = self._compiled
+        if compiled is None or url_mapping != compiled[0]:
+            lookup = {old_url: new_url for old_url, new_url in url_mapping.items() if old_url}
+            for old_url, new_url in list(lookup.items()):
+                if '&' in old_url:
+                    lookup.setdefault(old_url.replace('&', '&amp;'), new_url.replace('&', '&amp;'))
+            matcher = (_build_url_pattern(lookup), lookup) if lookup else None
+            compiled = self._compiled = (dict(url_mapping), matcher, _host_needles(lookup))
+        return compiled[1]
+    
+    def _may_contain_urls(self, data, url_mapping: Dict[str, str]) -> bool:
+        """用主机名子串查找快速判断数据中是否可能包含映射中的URL
+        
+        bytes和mmap的find都是C实现的子串查找，比完整的正则扫描快得多，
+        大部分文件不引用这些主机时可以跳过解码和替换。
+        """
+        self._get_matcher(url_mapping)
+        needles = self._compiled[2]
+        if needles is None:
+            return True
+        return any(data.find(needle) != -1 for needle in needles)
+    
+    def _get_bytes_matcher(self, url_mapping: Dict[str, str]) -> Optional[Tuple[re.Pattern, Dict[bytes, bytes]]]:
+        """获取_get_matcher的字节版本，正则和查找表都按UTF-8编码，直接在字节数据上匹配"""
+        matcher = self._get_matcher(url_mapping)
+        if matcher is None:
+            return None
+        
+        cached = self._bytes_compiled
+        if cached is None or cached[0] is not matcher:
+            pattern, lookup = matcher
+            bytes_lookup = {old_url.encode('utf-8'): new_url.encode('utf-8') for old_url, new_url in lookup.items()}
+            cached = self._bytes_compiled = (matcher, (re.compile(pattern.pattern.encode('utf-8')), bytes_lookup))
+        return cached[1]
     
     def replace_urls_in_file(self, file_path: str, url_mapping: Dict[str, str], 
                            output_path: Optional[str] = None, backup: bool = True) -> Dict:
@@ -42,40 +202,79 @@ class URLReplacer:
         }
         
         try:
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"文件不存在: {file_path}")
-            
             if not url_mapping:
                 raise ValueError("URL映射不能为空")
             
-            # 创建备份
-            if backup and (output_path is None or output_path == file_path):
-                backup_path = f"{file_path}.backup"
-                shutil.copy2(file_path, backup_path)
-                result['backup_path'] = backup_path
-                self.logger.info(f"已创建备份文件: {backup_path}")
+            # 获取文件扩展名以确定处理方式
+            file_ext = Path(file_path).suffix.lower()
+            output_file = output_path or file_path
             
-            # 读取文件内容
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                # 尝试其他编码
-                encodings = ['gbk', 'gb2312', 'latin1']
-                content = None
-                for encoding in encodings:
+                f = open(file_path, 'rb')
+            except FileNotFoundError:
+                raise FileNotFoundError(f"文件不存在: {file_path}")
+            
+            mapped = None
+            skipped = False
+            with f:
+                # 大文件用内存映射直接按字节替换，不把整个文件解码成字符串；
+                # 按标签属性解析HTML时仍需要完整的文档，不是UTF-8的文件也回退到解码方式
+                if (os.fstat(f.fileno()).st_size >= config.MMAP_THRESHOLD
+                        and not (config.HTML_PARSE_REPLACE and file_ext in ['.html', '.htm'])):
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if not self._may_contain_urls(mm, url_mapping):
+                            skipped = True
+                        elif _is_utf8(mm):
+                            self._backup_file(file_path, output_path, backup, result)
+                            mapped = self._replace_urls_in_mapped(mm, url_mapping, output_file)
+                
+                if mapped is None and not skipped:
+                    # 只读取一次原始字节，再依次尝试各种编码解码
+                    raw = f.read()
+                    skipped = not self._may_contain_urls(raw, url_mapping)
+            
+            if skipped:
+                # 文件中没有映射中任何URL的主机名，无需解码和替换；输出到其他位置时原样复制
+                if output_file != file_path:
+                    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
                     try:
-                        with open(file_path, 'r', encoding=encoding) as f:
-                            content = f.read()
-                        break
-                    except UnicodeDecodeError:
-                        continue
+                        shutil.copyfile(file_path, output_file)
+                    except shutil.SameFileError:
+                        pass
                 
-                if content is None:
-                    raise ValueError("无法解码文件内容")
+                result['success'] = True
+                self.logger.info(f"URL替换完成: {file_path} -> {output_file}, 替换了 0 个URL")
+                return result
             
-            # 获取文件扩展名以确定处理方式
-            file_ext = Path(file_path).suffix.lower()
+            if mapped is not None:
+                tmp_path, replacements = mapped
+                # 原文件关闭后再替换，Windows不允许替换仍被打开的文件
+                try:
+                    os.replace(tmp_path, output_file)
+                except OSError:
+                    os.remove(tmp_path)
+                    raise
+                
+                result.update({
+                    'success': True,
+                    'replacements': replacements
+                })
+                self.logger.info(f"URL替换完成: {file_path} -> {output_file}, 替换了 {replacements} 个URL")
+                return result
+            
+            content = None
+            for encoding in _DECODE_ENCODINGS:
+                try:
+                    content = raw.decode(encoding)
+                    break
+                except UnicodeDecodeError:
+                    continue
+            
+            if content is None:
+                raise ValueError("无法解码文件内容")
+            
+            # 创建备份
+            self._backup_file(file_path, output_path, backup, result)
             
             # 执行替换
             if file_ext in ['.html', '.htm']:
@@ -85,10 +284,7 @@ class URLReplacer:
             else:
                 new_content, replacements = self._replace_urls_in_text(content, url_mapping)
             
-            # 写入新内容
-            output_file = output_path or file_path
-            
-            # 确保输出目录存在
+            # 写入新内容，确保输出目录存在
             os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
             
             with open(output_file, 'w', encoding='utf-8') as f:
@@ -107,6 +303,49 @@ class URLReplacer:
         
         return result
     
+    def _backup_file(self, file_path: str, output_path: Optional[str], backup: bool, result: Dict):
+        """覆盖原文件时创建备份，并把备份路径记录到结果中"""
+        if backup and (output_path is None or output_path == file_path):
+            backup_path = f"{file_path}.backup"
+            shutil.copy2(file_path, backup_path)
+            result['backup_path'] = backup_path
+            self.logger.info(f"已创建备份文件: {backup_path}")
+    
+    def _replace_urls_in_mapped(self, data, url_mapping: Dict[str, str], output_file: str) -> Tuple[str, int]:
+        """在内存映射的UTF-8文件上按字节替换URL
+        
+        未匹配的片段原样分块写入输出目录中的临时文件，由调用方用os.replace原子地替换目标文件，
+        中途出错不会留下写了一半的文件。
+        
+        Returns:
+            (临时文件路径, 替换次数)
+        """
+        matcher = self._get_bytes_matcher(url_mapping)
+        matches = matcher[0].finditer(data) if matcher else ()
+        
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        os.makedirs(output_dir, exist_ok=True)
+        
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, prefix='.replace_', suffix='.tmp')
+        replacements = 0
+        try:
+            with os.fdopen(fd, 'wb', buffering=1 << 20) as out:
+                last = 0
+                for m in matches:
+                    start, end = m.span()
+                    out.write(data[last:start])
+                    out.write(matcher[1][m.group(0)])
+                    last = end
+                    replacements += 1
+                out.write(data[last:])
+            if os.path.exists(output_file):
+                shutil.copymode(output_file, tmp_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        
+        return tmp_path, replacements
+    
     def _replace_urls_in_text(self, content: str, url_mapping: Dict[str, str]) -> tuple:
         """在纯文本中替换URL
         
@@ -117,16 +356,13 @@ class URLReplacer:
         Returns:
             (新内容, 替换次数)
         """
-        new_content = content
-        replacements = 0
-        
-        for old_url, new_url in url_mapping.items():
-            # 精确匹配URL
-            if old_url in new_content:
-                new_content = new_content.replace(old_url, new_url)
-                replacements += content.count(old_url)
+        matcher = self._get_matcher(url_mapping)
+        if matcher is None:
+            return content, 0
         
-        return new_content, replacements
+        # 一次扫描替换所有URL
+        pattern, lookup = matcher
+        return pattern.subn(lambda m: lookup[m.group(0)], content)
     
     def _replace_urls_in_markdown(self, content: str, url_mapping: Dict[str, str]) -> tuple:
         """在Markdown中替换URL
@@ -138,31 +374,9 @@ class URLReplacer:
         Returns:
             (新内容, 替换次数)
         """
-        new_content = content
-        replacements = 0
-        
-        for old_url, new_url in url_mapping.items():
-            # 替换Markdown图片语法中的URL
-            md_pattern = r'(!\[.*?\]\()' + re.escape(old_url) + r'(\))'
-            matches = re.findall(md_pattern, new_content)
-            if matches:
-                new_content = re.sub(md_pattern, r'\1' + new_url + r'\2', new_content)
-                replacements += len(matches)
-            
-            # 替换HTML img标签中的URL
-            img_pattern = r'(<img[^>]+src=["\']?)' + re.escape(old_url) + r'(["\']?[^>]*>)'
-            matches = re.findall(img_pattern, new_content, re.IGNORECASE)
-            if matches:
-                new_content = re.sub(img_pattern, r'\1' + new_url + r'\2', new_content, flags=re.IGNORECASE)
-                replacements += len(matches)
-            
-            # 替换普通URL
-            if old_url in new_content:
-                count = new_content.count(old_url)
-                new_content = new_content.replace(old_url, new_url)
-                replacements += count
-        
-        return new_content, replacements
+        # Markdown图片语法、HTML img标签和普通链接中的URL都是原样出现的，
+        # 直接按文本一次扫描替换即可
+        return self._replace_urls_in_text(content, url_mapping)
     
     def _replace_urls_in_html(self, content: str, url_mapping: Dict[str, str]) -> tuple:
         """在HTML中替换URL
@@ -174,6 +388,16 @@ class URLReplacer:
         Returns:
             (新内容, 替换次数)
         """
+        matcher = self._get_matcher(url_mapping)
+        if matcher is None or not matcher[0].search(content):
+            # 文件中没有需要替换的URL，不解析也不重新序列化
+            return content, 0
+        
+        if not config.HTML_PARSE_REPLACE:
+            # URL在src、style和<style>中都是原样（或&amp;转义后）出现的，直接按文本替换，
+            # 同时保留文档原有的格式
+            return self._replace_urls_in_text(content, url_mapping)
+        
         replacements = 0
         
         try:
@@ -197,24 +421,18 @@ class URLReplacer:
             style_tags = soup.find_all(['style', 'link'])
             for tag in style_tags:
                 if tag.name == 'style' and tag.string:
-                    new_css = tag.string
-                    for old_url, new_url in url_mapping.items():
-                        if old_url in new_css:
-                            new_css = new_css.replace(old_url, new_url)
-                            replacements += 1
-                    tag.string = new_css
+                    new_css, count = self._replace_urls_in_text(tag.string, url_mapping)
+                    if count:
+                        tag.string = new_css
+                        replacements += count
             
             # 替换内联样式
             elements_with_style = soup.find_all(attrs={'style': True})
             for element in elements_with_style:
-                style = element.get('style', '')
-                new_style = style
-                for old_url, new_url in url_mapping.items():
-                    if old_url in new_style:
-                        new_style = new_style.replace(old_url, new_url)
-                        replacements += 1
-                if new_style != style:
+                new_style, count = self._replace_urls_in_text(element.get('style', ''), url_mapping)
+                if count:
                     element['style'] = new_style
+                    replacements += count
             
             new_content = str(soup)
             
@@ -248,36 +466,31 @@ class URLReplacer:
         
         self.logger.info(f"开始替换目录中的URL: {directory_path}")
         
-        results = []
-        supported_formats = ['.txt', '.md', '.html', '.htm']
+        file_paths = list(_iter_target_files(directory_path, recursive))
         
-        # 遍历目录
-        if recursive:
-            for root, dirs, files in os.walk(directory_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if Path(file_path).suffix.lower() in supported_formats:
-                        # 计算输出路径
-                        if output_directory:
-                            rel_path = os.path.relpath(file_path, directory_path)
-                            output_path = os.path.join(output_directory, rel_path)
-                        else:
-                            output_path = None
-                        
-                        result = self.replace_urls_in_file(file_path, url_mapping, output_path, backup)
-                        results.append(result)
+        # 计算输出路径
+        if output_directory:
+            output_paths = [
+                os.path.join(output_directory, os.path.relpath(file_path, directory_path))
+                for file_path in file_paths
+            ]
         else:
-            for file in os.listdir(directory_path):
-                file_path = os.path.join(directory_path, file)
-                if os.path.isfile(file_path) and Path(file_path).suffix.lower() in supported_formats:
-                    # 计算输出路径
-                    if output_directory:
-                        output_path = os.path.join(output_directory, file)
-                    else:
-                        output_path = None
-                    
-                    result = self.replace_urls_in_file(file_path, url_mapping, output_path, backup)
-                    results.append(result)
+            output_paths = [None] * len(file_paths)
+        
+        # 每个文件的读取、替换、写入互不依赖，文件较多时使用多进程并行处理
+        if len(file_paths) >= config.PARALLEL_MIN_FILES:
+            # 先在主进程编译好正则，随替换器一起发送给子进程
+            self._get_matcher(url_mapping)
+            with ProcessPoolExecutor(initializer=setup_worker_logging) as executor:
+                results = list(executor.map(
+                    self.replace_urls_in_file, file_paths, repeat(url_mapping), output_paths, repeat(backup),
+                    chunksize=8
+                ))
+        else:
+            results = [
+                self.replace_urls_in_file(file_path, url_mapping, output_path, backup)
+                for file_path, output_path in zip(file_paths, output_paths)
+            ]
         
         # 统计结果
         successful_files = sum(1 for r in results if r['success'])
@@ -5,44 +5,171 @@
 
 import os
 import re
+import mmap
+import time
+import queue
+import atexit
+import hashlib
 import logging
-from urllib.parse import urlparse, urljoin
+import logging.handlers
+import threading
+from urllib.parse import urlparse, urljoin, urlsplit, urlunsplit
 from pathlib import Path
-from typing import List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import orjson
+from charset_normalizer import from_bytes
 
 import config
 
 
+# 匹配HTTP/HTTPS图片链接的正则表达式
+_IMAGE_URL_PATTERN = r'https?://[^\s<>"\'{}},|\\^`\[\]]+\.(?:jpg|jpeg|png|gif|bmp|webp)(?:\?[^\s<>"\'{}},|\\^`\[\]]*)?'
+_IMAGE_URL_RE = re.compile(_IMAGE_URL_PATTERN, re.IGNORECASE)
+
+# 字符串模式中\s匹配、但字节模式中\s不匹配的空白字符（如不换行空格、全角空格）
+_NON_ASCII_SPACES = '\x85\xa0\u1680' + ''.join(map(chr, range(0x2000, 0x200b))) + '\u2028\u2029\u202f\u205f\u3000'
+# 字节版本的URL字符：ASCII字符按原规则判断（字节模式的\s不含\x1c-\x1f，需要单独排除），
+# 非ASCII字节排除上述空白字符的UTF-8编码，使提取结果与字符串版本一致
+_URL_CHAR_BYTES = (
+    rb'(?:[^\s\x1c-\x1f<>"\'{}},|\\^`\[\]\x80-\xff]|(?!'
+    + b'|'.join(re.escape(c.encode('utf-8')) for c in _NON_ASCII_SPACES)
+    + rb')[\x80-\xff])'
+)
+# 字节版本，用于直接扫描内存映射的大文件
+_IMAGE_URL_BYTES_RE = re.compile(
+    rb'https?://' + _URL_CHAR_BYTES + rb'+\.(?:jpg|jpeg|png|gif|bmp|webp)(?:\?' + _URL_CHAR_BYTES + rb'*)?',
+    re.IGNORECASE
+)
+
+# 路径以支持的图片扩展名结尾
+_IMAGE_EXT_RE = re.compile('(?:' + '|'.join(map(re.escape, config.SUPPORTED_FORMATS)) + ')$', re.IGNORECASE)
+# URL中任意位置出现图片格式关键词
+_IMAGE_FORMAT_KEYWORD_RE = re.compile('|'.join(ext.replace('.', '') for ext in config.SUPPORTED_FORMATS), re.IGNORECASE)
+
+# 文件大小单位，依次为1024的0~4次幂
+_SIZE_NAMES = ("B", "KB", "MB", "GB", "TB")
+
+# 文件名中的非法字符替换为下划线
+_FILENAME_TRANSLATION = str.maketrans({c: '_' for c in '<>:"/\\|?*\x00'})
+
+# 图片文件头（魔数）到格式的映射
+_IMAGE_MAGIC = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+
+
 def setup_logging():
-    """设置日志配置"""
-    # 创建日志目录
-    os.makedirs(config.LOG_DIR, exist_ok=True)
+    """设置日志配置
     
-    # 配置日志
-    logging.basicConfig(
-        level=getattr(logging, config.LOG_LEVEL),
-        format=config.LOG_FORMAT,
-        handlers=[
-            logging.FileHandler(os.path.join(config.LOG_DIR, 'app.log'), encoding='utf-8'),
-            logging.StreamHandler()
-        ]
-    )
+    日志记录先放入队列，由后台线程统一写入文件和控制台，
+    并发下载、上传的线程写日志时不会在文件和控制台的锁上互相等待。
+    """
+    # 配置日志，已经配置过时不再重复添加
+    root = logging.getLogger()
+    if not root.handlers:
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, *_create_log_handlers())
+        listener.start()
+        # 退出前写完队列中剩余的日志
+        atexit.register(listener.stop)
+        
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(getattr(logging, config.LOG_LEVEL))
     
     return logging.getLogger(__name__)
 
 
+def setup_worker_logging():
+    """设置子进程的日志配置，作为进程池的initializer使用
+    
+    子进程中没有写出日志队列的后台线程，继承来的队列处理器会丢失日志，
+    因此改为直接写入文件和控制台。
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in _create_log_handlers():
+        root.addHandler(handler)
+    root.setLevel(getattr(logging, config.LOG_LEVEL))
+
+
+def _create_log_handlers() -> List[logging.Handler]:
+    """创建写入日志文件和控制台的处理器"""
+    # 创建日志目录
+    os.makedirs(config.LOG_DIR, exist_ok=True)
+    
+    formatter = logging.Formatter(config.LOG_FORMAT)
+    handlers = [
+        logging.FileHandler(os.path.join(config.LOG_DIR, 'app.log'), encoding='utf-8'),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
 def create_directories():
     """创建必要的目录"""
-    directories = [config.DOWNLOAD_DIR, config.LOG_DIR]
+    directories = [config.DOWNLOAD_DIR, config.CACHE_DIR, config.LOG_DIR]
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
 
 
+def _write_bytes(file_path: str, data: bytes):
+    """把数据一次性写入文件"""
+    with open(file_path, 'wb', buffering=1 << 20) as f:
+        f.write(data)
+
+
+def save_text(file_path: str, text: str):
+    """把文本编码后一次性写入文件"""
+    _write_bytes(file_path, text.encode('utf-8'))
+
+
+def save_json(file_path: str, obj):
+    """使用orjson把对象序列化为带缩进的JSON后一次性写入文件"""
+    _write_bytes(file_path, orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+
+def load_json(file_path: str):
+    """使用orjson读取JSON文件"""
+    with open(file_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def read_text_file(file_path: str) -> str:
+    """读取文本文件内容，只读取一次原始字节后再解码
+    
+    优先按UTF-8解码，失败时使用charset_normalizer检测编码。
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        best = from_bytes(data).best()
+        encoding = best.encoding if best else 'latin1'
+        return data.decode(encoding, errors='replace')
+
+
 def is_valid_image_url(url: str) -> bool:
     """检查是否为有效的图片URL"""
     if not url or not isinstance(url, str):
         return False
     
+    return _is_valid_image_url(url)
+
+
+@lru_cache(maxsize=8192)
+def _is_valid_image_url(url: str) -> bool:
+    """检查是否为有效的图片URL（结果缓存，同一URL只解析一次）"""
     # 检查URL格式
     try:
         parsed = urlparse(url)
@@ -51,20 +178,16 @@ def is_valid_image_url(url: str) -> bool:
     except Exception:
         return False
     
-    # 检查文件扩展名或者是否包含图片相关的查询参数
-    path = parsed.path.lower()
-    url_lower = url.lower()
-    
     # 检查路径中的扩展名
-    if any(path.endswith(ext) for ext in config.SUPPORTED_FORMATS):
+    if _IMAGE_EXT_RE.search(parsed.path):
         return True
     
     # 检查URL中是否包含图片格式关键词（适用于动态图片URL）
-    if any(ext.replace('.', '') in url_lower for ext in config.SUPPORTED_FORMATS):
+    if _IMAGE_FORMAT_KEYWORD_RE.search(url):
         return True
     
     # 检查是否为图片服务（如picsum.photos）
-    if 'picsum.photos' in parsed.netloc or 'image' in url_lower:
+    if 'picsum.photos' in parsed.netloc or 'image' in url.lower():
         return True
     
     return False
@@ -72,11 +195,8 @@ def is_valid_image_url(url: str) -> bool:
 
 def extract_image_urls_from_text(text: str) -> List[str]:
     """从文本中提取图片URL"""
-    # 匹配HTTP/HTTPS图片链接的正则表达式
-    url_pattern = r'https?://[^\s<>"\'{}},|\\^`\[\]]+\.(?:jpg|jpeg|png|gif|bmp|webp)(?:\?[^\s<>"\'{}},|\\^`\[\]]*)?'
-    
     # 直接查找完整的URL
-    full_urls = re.findall(url_pattern, text, re.IGNORECASE)
+    full_urls = _IMAGE_URL_RE.findall(text)
     
     # 去重并验证
     valid_urls = []
@@ -87,15 +207,91 @@ def extract_image_urls_from_text(text: str) -> List[str]:
     return valid_urls
 
 
+def extract_image_urls_from_large_file(file_path: str) -> List[str]:
+    """通过内存映射扫描大文件中的图片URL
+    
+    正则直接在mmap上按需扫描页面，不需要把整个文件读入并解码成字符串，
+    只保留匹配到的URL。
+    """
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        full_urls = {m.group(0).decode('utf-8', errors='replace') for m in _IMAGE_URL_BYTES_RE.finditer(mm)}
+    
+    # 去重并验证
+    valid_urls = []
+    for url in full_urls:
+        if is_valid_image_url(url):
+            valid_urls.append(url)
+    
+    return valid_urls
+
+
+def normalize_url(url: str) -> str:
+    """规范化URL，用于判断不同写法的URL是否指向同一资源
+    
+    协议和主机名转为小写，去掉默认端口、片段以及空的查询串。
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def group_duplicate_urls(urls: List[str]) -> Dict[str, List[str]]:
+    """按规范化URL对URL分组，保持首次出现的顺序
+    
+    Returns:
+        每组第一个URL到该组所有URL的映射，只需下载键中的URL，结果再分发给组内所有URL
+    """
+    groups = {}
+    canonical = {}
+    # dict.fromkeys先去掉完全相同的URL并保持顺序
+    for url in dict.fromkeys(urls):
+        first = canonical.setdefault(normalize_url(url), url)
+        groups.setdefault(first, []).append(url)
+    return groups
+
+
+def detect_image_format(head: bytes) -> Optional[str]:
+    """根据文件头识别图片格式
+    
+    Args:
+        head: 文件开头的若干字节（至少12字节）
+        
+    Returns:
+        图片格式名称，不是支持的图片格式时返回None
+    """
+    head = bytes(head)
+    for magic, fmt in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return fmt
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def is_valid_image_magic(file_path: str) -> bool:
+    """只读取文件头判断文件是否为支持的图片格式，不解析整个图片"""
+    with open(file_path, 'rb') as f:
+        head = f.read(32)
+    return detect_image_format(head) is not None
+
+
+def short_hash(text: str) -> str:
+    """生成8位十六进制短哈希，用于文件名和图片ID"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=4).hexdigest()
+
+
+@lru_cache(maxsize=4096)
 def get_filename_from_url(url: str) -> str:
-    """从URL中提取文件名"""
+    """从URL中提取文件名（同一URL在下载、缓存等环节会被多次调用，结果缓存）"""
     parsed = urlparse(url)
     filename = os.path.basename(parsed.path)
     
     # 如果没有文件名，生成一个
     if not filename or '.' not in filename:
-        import hashlib
-        url_hash = hashlib.md5(url.encode()).hexdigest()[:8]
+        url_hash = short_hash(url)
         filename = f"image_{url_hash}.jpg"
     
     return filename
@@ -104,7 +300,7 @@ def get_filename_from_url(url: str) -> str:
 def sanitize_filename(filename: str) -> str:
     """清理文件名，移除非法字符"""
     # 移除或替换非法字符
-    filename = re.sub(r'[<>:"/\\|?*]', '_', filename)
+    filename = filename.translate(_FILENAME_TRANSLATION)
     # 限制长度
     if len(filename) > 100:
         name, ext = os.path.splitext(filename)
@@ -115,13 +311,47 @@ def sanitize_filename(filename: str) -> str:
 
 def format_file_size(size_bytes: int) -> str:
     """格式化文件大小显示"""
-    if size_bytes == 0:
+    if size_bytes <= 0:
         return "0B"
     
-    size_names = ["B", "KB", "MB", "GB"]
-    import math
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
+    # bit_length直接算出1024的幂次，无需浮点对数运算
+    i = min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_NAMES) - 1)
+    s = round(size_bytes / (1 << (10 * i)), 2)
+    
+    return f"{s} {_SIZE_NAMES[i]}"
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """判断请求错误是否值得重试：网络错误、超时、429和5xx可以重试，其他4xx不重试"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return response.status_code == 429 or response.status_code >= 500
+
+
+class RateLimiter:
+    """线程安全的令牌桶限速器
+    
+    令牌按rate个/秒的速度补充，最多积累capacity个，允许短时间的突发请求；
+    令牌不足时acquire阻塞到有可用令牌为止。
+    """
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
     
-    return f"{s} {size_names[i]}"
\ No newline at end of file
+    def acquire(self):
+        """获取一个令牌"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
\ No newline at end of file
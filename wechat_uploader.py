@@ -5,16 +5,137 @@
 
 import os
 import time
-import json
+import random
+import heapq
+import hashlib
 import logging
+import mimetypes
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, as_completed, wait
+from functools import partial
+from itertools import count
 from typing import Dict, List, Optional, Tuple
 from urllib.parse import urljoin
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
 from tqdm import tqdm
 
 import config
-from utils import format_file_size
+from utils import format_file_size, RateLimiter, is_retryable_error, detect_image_format
+
+
+class _UploadAdapter(HTTPAdapter):
+    """按较大的块发送请求体的连接适配器
+    
+    流式上传时连接每次从MultipartEncoder读取blocksize字节再写入套接字，
+    默认的16KB块对接近大小上限的图片意味着数百次读取和TLS记录，改为按配置的块大小发送。
+    """
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('blocksize', config.UPLOAD_SEND_BLOCKSIZE)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _file_digest(path: str) -> str:
+    """分块读取文件计算内容哈希，用于识别内容相同的图片"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_size_or_none(path: str) -> Optional[int]:
+    """返回文件大小，文件不存在或无法访问时返回None"""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+class TokenStore(ABC):
+    """访问令牌的持久化存储接口，进程重启后可以复用未过期的令牌"""
+    
+    @abstractmethod
+    def get(self, appid: str) -> Optional[Tuple[str, float]]:
+        """读取保存的令牌
+        
+        Returns:
+            (访问令牌, 过期时间戳)，没有保存时返回None
+        """
+    
+    @abstractmethod
+    def set(self, appid: str, access_token: str, expires_at: float):
+        """保存访问令牌及其过期时间戳"""
+
+
+class FileTokenStore(TokenStore):
+    """把访问令牌保存在本地JSON文件中，按AppID区分
+    
+    先写入临时文件再用os.replace替换，其他进程不会读到写了一半的文件；
+    临时文件由mkstemp创建，只有当前用户可读写。
+    """
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config.WECHAT_TOKEN_FILE
+    
+    def _load(self) -> Dict:
+        try:
+            with open(self.path, 'rb') as f:
+                return orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return {}
+    
+    def get(self, appid: str) -> Optional[Tuple[str, float]]:
+        entry = self._load().get(appid)
+        if not entry:
+            return None
+        return entry['access_token'], entry['expires_at']
+    
+    def set(self, appid: str, access_token: str, expires_at: float):
+        tokens = self._load()
+        tokens[appid] = {'access_token': access_token, 'expires_at': expires_at}
+        
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(orjson.dumps(tokens))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+class RedisTokenStore(TokenStore):
+    """把访问令牌保存在Redis中，多台机器上的进程共享同一个令牌
+    
+    client为redis.Redis或接口兼容的客户端，键的过期时间与令牌一致，过期后由Redis自动删除。
+    """
+    
+    def __init__(self, client, key_prefix: str = 'wechat:access_token:'):
+        self.client = client
+        self.key_prefix = key_prefix
+    
+    def get(self, appid: str) -> Optional[Tuple[str, float]]:
+        value = self.client.get(self.key_prefix + appid)
+        if not value:
+            return None
+        entry = orjson.loads(value)
+        return entry['access_token'], entry['expires_at']
+    
+    def set(self, appid: str, access_token: str, expires_at: float):
+        ttl = int(expires_at - time.time())
+        if ttl <= 0:
+            return
+        value = orjson.dumps({'access_token': access_token, 'expires_at': expires_at})
+        self.client.set(self.key_prefix + appid, value, ex=ttl)
 
 
 class WeChatUploader:
@@ -25,12 +146,20 @@ class WeChatUploader:
     UPLOAD_URL = "https://api.weixin.qq.com/cgi-bin/media/upload"
     UPLOAD_IMG_URL = "https://api.weixin.qq.com/cgi-bin/media/uploadimg"
     
-    def __init__(self, appid: str = None, secret: str = None):
+    # 表示访问令牌无效或已过期的错误码，刷新令牌后可以重试
+    TOKEN_ERROR_CODES = (40001, 40014, 42001)
+    # 系统繁忙或调用频率超限，退避后可以重试
+    THROTTLE_ERROR_CODES = (-1, 45011, 45015)
+    # 接口调用次数已达每日上限，当天重试也不会成功
+    QUOTA_ERROR_CODES = (45009,)
+    
+    def __init__(self, appid: str = None, secret: str = None, token_store: Optional[TokenStore] = None):
         """初始化上传器
         
         Args:
             appid: 微信公众号AppID
             secret: 微信公众号AppSecret
+            token_store: 访问令牌的持久化存储，默认保存到config.WECHAT_TOKEN_FILE，该配置为空时不持久化
         """
         self.logger = logging.getLogger(__name__)
         
@@ -43,11 +172,44 @@ class WeChatUploader:
         
         self.access_token = None
         self.token_expires_at = 0
+        # 保证同一时间只有一个线程刷新令牌并写入持久化存储
+        self._token_lock = threading.Lock()
+        # 达到每日调用上限时记录返回的错误，之后的上传不再发送请求
+        self._quota_error = None
+        
+        # (内容哈希, 是否永久素材)到上传任务的映射，内容相同的图片只上传一次
+        self._uploads_by_digest: Dict[Tuple[str, bool], Future] = {}
+        self._upload_cache_loaded = False
+        self._dedup_lock = threading.Lock()
+        
+        # 预上传使用的后台线程池（首次预上传时创建），以及(路径, 是否永久素材)到上传任务的映射
+        self._prefetch_executor = None
+        self._prefetched: Dict[Tuple[str, bool], Future] = {}
+        self._prefetch_lock = threading.Lock()
+        if token_store is None and config.WECHAT_TOKEN_FILE:
+            token_store = FileTokenStore()
+        self.token_store = token_store
         
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'WeChat-Image-Uploader/1.0'
         })
+        # 连接池留有余量，并发上传、令牌刷新等请求都能复用已建立的keep-alive连接，省去TCP和TLS握手；
+        # 重试由上传逻辑自行处理，适配器不重试
+        adapter = _UploadAdapter(
+            pool_connections=4,
+            pool_maxsize=max(16, config.UPLOAD_CONCURRENCY * 2),
+            max_retries=0,
+            pool_block=False
+        )
+        self.session.mount('https://', adapter)
+        
+        # 每个上传接口一个令牌桶限速器，所有上传线程共享；两个接口的频率限制不同，分别配置。
+        # 令牌充足时允许突发请求，只有桶空时才等待
+        self._upload_limiters = {
+            self.UPLOAD_IMG_URL: RateLimiter(config.UPLOAD_RATE_LIMIT),
+            self.UPLOAD_URL: RateLimiter(config.MEDIA_UPLOAD_RATE_LIMIT),
+        }
     
     def get_access_token(self, force_refresh: bool = False) -> str:
         """获取访问令牌
@@ -58,14 +220,42 @@ class WeChatUploader:
         Returns:
             访问令牌
         """
-        current_time = time.time()
-        
         # 如果令牌未过期且不强制刷新，直接返回
-        if (not force_refresh and 
-            self.access_token and 
-            current_time < self.token_expires_at):
+        if not force_refresh and self._token_is_fresh():
             return self.access_token
         
+        # 加锁后再检查一次：多个线程同时发现令牌过期时只有一个线程刷新，其余线程直接使用新令牌
+        with self._token_lock:
+            if not force_refresh and self._token_is_fresh():
+                return self.access_token
+            return self._refresh_access_token(force_refresh)
+    
+    def _renew_invalid_token(self, invalid_token: str) -> str:
+        """接口报告令牌失效后获取新令牌
+        
+        多个线程拿着同一个失效的令牌时，只有第一个线程刷新，其余线程直接使用刷新后的令牌。
+        """
+        with self._token_lock:
+            if self.access_token != invalid_token and self._token_is_fresh():
+                return self.access_token
+            return self._refresh_access_token(force_refresh=True)
+    
+    def _token_is_fresh(self) -> bool:
+        """内存中的令牌是否存在且未过期"""
+        return bool(self.access_token) and time.time() < self.token_expires_at
+    
+    def _refresh_access_token(self, force_refresh: bool) -> str:
+        """从持久化存储或微信接口获取令牌，调用方需持有_token_lock"""
+        current_time = time.time()
+        
+        # 其他进程保存过未过期的令牌时直接复用，节省获取令牌接口的每日调用次数
+        if not force_refresh:
+            stored = self._load_stored_token()
+            if stored and current_time < stored[1]:
+                self.access_token, self.token_expires_at = stored
+                self.logger.info("使用已保存的微信访问令牌")
+                return self.access_token
+        
         self.logger.info("获取微信访问令牌")
         
         try:
@@ -82,7 +272,7 @@ class WeChatUploader:
             )
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             
             if 'access_token' not in data:
                 error_msg = data.get('errmsg', '未知错误')
@@ -91,19 +281,56 @@ class WeChatUploader:
             
             self.access_token = data['access_token']
             expires_in = data.get('expires_in', 7200)  # 默认2小时
-            self.token_expires_at = current_time + expires_in - 300  # 提前5分钟过期
+            # 提前刷新的余量按有效期的5%计算，限制在30秒到5分钟之间
+            margin = min(300, max(30, expires_in * 0.05))
+            self.token_expires_at = current_time + expires_in - margin
+            self._save_stored_token()
             
-            self.logger.info(f"访问令牌获取成功，有效期: {expires_in} 秒")
+            self.logger.info("访问令牌获取成功")
+            self.logger.debug(f"访问令牌有效期: {expires_in} 秒，提前 {margin:.0f} 秒刷新")
             return self.access_token
             
         except requests.exceptions.RequestException as e:
             raise Exception(f"网络请求失败: {str(e)}")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise Exception(f"响应解析失败: {str(e)}")
         except Exception as e:
             self.logger.error(f"获取访问令牌失败: {str(e)}")
             raise
     
+    def _load_stored_token(self) -> Optional[Tuple[str, float]]:
+        """从持久化存储读取令牌，存储不可用时只记录警告"""
+        if not self.token_store:
+            return None
+        try:
+            return self.token_store.get(self.appid)
+        except Exception as e:
+            self.logger.warning(f"读取保存的访问令牌失败: {str(e)}")
+            return None
+    
+    def _save_stored_token(self):
+        """把当前令牌写入持久化存储，存储不可用时只记录警告"""
+        if not self.token_store:
+            return
+        try:
+            self.token_store.set(self.appid, self.access_token, self.token_expires_at)
+        except Exception as e:
+            self.logger.warning(f"保存访问令牌失败: {str(e)}")
+    
+    def _open_image(self, image_path: str):
+        """打开图片文件并通过fstat获取大小
+        
+        直接打开文件，不再先后调用exists、getsize和open，在网络文件系统上可以省去多次元数据请求。
+        
+        Returns:
+            (文件对象, 文件大小)
+        """
+        try:
+            f = open(image_path, 'rb')
+        except FileNotFoundError:
+            raise FileNotFoundError(f"图片文件不存在: {image_path}")
+        return f, os.fstat(f.fileno()).st_size
+    
     def upload_image(self, image_path: str, media_type: str = 'image') -> Dict:
         """上传单张图片到微信公众号
         
@@ -123,42 +350,27 @@ class WeChatUploader:
         }
         
         try:
-            if not os.path.exists(image_path):
-                raise FileNotFoundError(f"图片文件不存在: {image_path}")
-            
-            # 检查文件大小
-            file_size = os.path.getsize(image_path)
-            if file_size > config.MAX_IMAGE_SIZE:
-                raise ValueError(f"图片文件过大: {format_file_size(file_size)}")
-            
-            # 获取访问令牌
-            access_token = self.get_access_token()
-            
-            self.logger.info(f"开始上传图片: {image_path} ({format_file_size(file_size)})")
-            
-            # 准备上传参数
-            params = {
-                'access_token': access_token,
-                'type': media_type
-            }
-            
-            # 准备文件数据
-            filename = os.path.basename(image_path)
-            with open(image_path, 'rb') as f:
-                files = {
-                    'media': (filename, f, 'image/jpeg')
+            f, file_size = self._open_image(image_path)
+            with f:
+                # 检查文件大小
+                if file_size > config.MAX_IMAGE_SIZE:
+                    raise ValueError(f"图片文件过大: {format_file_size(file_size)}")
+                
+                # 获取访问令牌
+                access_token = self.get_access_token()
+                
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info(f"开始上传图片: {image_path} ({format_file_size(file_size)})")
+                
+                # 准备上传参数
+                params = {
+                    'access_token': access_token,
+                    'type': media_type
                 }
                 
                 # 上传图片
-                response = self.session.post(
-                    self.UPLOAD_URL,
-                    params=params,
-                    files=files,
-                    timeout=config.REQUEST_TIMEOUT * 2  # 上传时间可能较长
-                )
-                response.raise_for_status()
-            
-            data = response.json()
+                filename = os.path.basename(image_path)
+                data = self._post_media(self.UPLOAD_URL, params, filename, f)
             
             if 'media_id' not in data:
                 error_msg = data.get('errmsg', '未知错误')
@@ -207,35 +419,21 @@ class WeChatUploader:
         }
         
         try:
-            if not os.path.exists(image_path):
-                raise FileNotFoundError(f"图片文件不存在: {image_path}")
-            
-            # 获取访问令牌
-            access_token = self.get_access_token()
-            
-            file_size = os.path.getsize(image_path)
-            self.logger.info(f"开始上传永久图片: {image_path} ({format_file_size(file_size)})")
-            
-            # 使用uploadimg接口上传永久图片
-            params = {
-                'access_token': access_token
-            }
-            
-            filename = os.path.basename(image_path)
-            with open(image_path, 'rb') as f:
-                files = {
-                    'media': (filename, f, 'image/jpeg')
+            f, file_size = self._open_image(image_path)
+            with f:
+                # 获取访问令牌
+                access_token = self.get_access_token()
+                
+                if self.logger.isEnabledFor(logging.INFO):
+                    self.logger.info(f"开始上传永久图片: {image_path} ({format_file_size(file_size)})")
+                
+                # 使用uploadimg接口上传永久图片
+                params = {
+                    'access_token': access_token
                 }
                 
-                response = self.session.post(
-                    self.UPLOAD_IMG_URL,
-                    params=params,
-                    files=files,
-                    timeout=config.REQUEST_TIMEOUT * 2
-                )
-                response.raise_for_status()
-            
-            data = response.json()
+                filename = os.path.basename(image_path)
+                data = self._post_media(self.UPLOAD_IMG_URL, params, filename, f)
             
             if 'url' not in data:
                 error_msg = data.get('errmsg', '未知错误')
@@ -256,43 +454,393 @@ class WeChatUploader:
         
         return result
     
-    def upload_images_batch(self, image_paths: List[str], permanent: bool = True) -> List[Dict]:
+    def upload(self, image_path: str, permanent: bool = True) -> Dict:
+        """按素材类型上传单张图片，内容与已上传的图片相同时直接复用结果
+        
+        Args:
+            image_path: 图片本地路径
+            permanent: 是否上传为永久素材
+            
+        Returns:
+            上传结果字典
+        """
+        if permanent:
+            upload_func = partial(self.upload_permanent_image, image_path)
+        else:
+            upload_func = partial(self.upload_image, image_path)
+        
+        try:
+            digest = _file_digest(image_path)
+        except OSError:
+            # 文件无法读取时由上传方法生成失败结果
+            return upload_func()
+        
+        return self._upload_deduplicated(digest, permanent, upload_func, image_path, {'local_path': image_path})
+    
+    def _upload_deduplicated(self, digest: str, permanent: bool, upload_func, name: str, overrides: Dict) -> Dict:
+        """按内容哈希去重上传
+        
+        相同内容的图片正在上传时等待其结果，已上传成功时直接复用，不再发送请求；
+        永久素材的结果追加记录到config.UPLOAD_CACHE_FILE，之后运行时同样可以复用。
+        
+        Args:
+            digest: 图片内容哈希
+            permanent: 是否上传为永久素材
+            upload_func: 实际执行上传的函数
+            name: 日志中显示的图片名称
+            overrides: 复用结果时需要替换的字段（如本地路径）
+            
+        Returns:
+            上传结果字典
+        """
+        self._load_upload_cache()
+        
+        key = (digest, permanent)
+        with self._dedup_lock:
+            future = self._uploads_by_digest.get(key)
+            owner = future is None
+            if owner:
+                future = self._uploads_by_digest[key] = Future()
+        
+        if not owner:
+            result = future.result()
+            if result['success']:
+                self.logger.info(f"图片内容与已上传的图片相同，复用上传结果: {name}")
+                return dict(result, **overrides)
+            return upload_func()
+        
+        try:
+            result = upload_func()
+        except BaseException as e:
+            with self._dedup_lock:
+                del self._uploads_by_digest[key]
+            future.set_exception(e)
+            raise
+        
+        if not result['success']:
+            # 失败的结果不保留，之后相同内容的图片重新上传
+            with self._dedup_lock:
+                del self._uploads_by_digest[key]
+        elif permanent:
+            self._append_upload_cache(digest, result)
+        future.set_result(result)
+        return result
+    
+    def _load_upload_cache(self):
+        """首次上传前读取之前运行时记录的永久素材上传结果"""
+        if self._upload_cache_loaded:
+            return
+        
+        with self._dedup_lock:
+            if self._upload_cache_loaded:
+                return
+            self._upload_cache_loaded = True
+            if not config.UPLOAD_CACHE_FILE:
+                return
+            
+            try:
+                with open(config.UPLOAD_CACHE_FILE, 'rb') as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                return
+            
+            for line in lines:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # 跳过写了一半的行
+                    continue
+                if not isinstance(entry, dict) or entry.get('appid') != self.appid:
+                    continue
+                digest = entry.get('digest')
+                media_url = entry.get('media_url')
+                # 跳过缺少必要字段的记录
+                if not digest or not media_url:
+                    continue
+                future = Future()
+                future.set_result({
+                    'local_path': None,
+                    'success': True,
+                    'media_id': entry.get('media_id', ''),
+                    'media_url': media_url,
+                    'error': None
+                })
+                self._uploads_by_digest[(digest, True)] = future
+    
+    def _append_upload_cache(self, digest: str, result: Dict):
+        """追加一条永久素材的上传记录，每次只写一行，不重写整个文件"""
+        if not config.UPLOAD_CACHE_FILE:
+            return
+        
+        line = orjson.dumps({
+            'appid': self.appid,
+            'digest': digest,
+            'media_id': result.get('media_id', ''),
+            'media_url': result['media_url']
+        }) + b'\n'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(config.UPLOAD_CACHE_FILE)), exist_ok=True)
+            with self._dedup_lock, open(config.UPLOAD_CACHE_FILE, 'ab') as f:
+                f.write(line)
+        except OSError as e:
+            self.logger.warning(f"记录上传结果失败: {str(e)}")
+    
+    def prefetch(self, image_paths: List[str], permanent: bool = True) -> Dict[str, Future]:
+        """在后台提前开始上传图片，调用方确定要发布时再通过get_or_upload取结果
+        
+        已经在预上传或已成功上传的路径不会重复提交。
+        
+        Args:
+            image_paths: 图片路径列表
+            permanent: 是否上传为永久素材
+            
+        Returns:
+            图片路径到上传任务的映射
+        """
+        futures = {}
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=config.UPLOAD_CONCURRENCY)
+            for image_path in image_paths:
+                key = (image_path, permanent)
+                future = self._prefetched.get(key)
+                if future is None:
+                    future = self._prefetched[key] = self._prefetch_executor.submit(self.upload, image_path, permanent)
+                futures[image_path] = future
+        return futures
+    
+    def get_or_upload(self, image_path: str, permanent: bool = True) -> Dict:
+        """获取图片的上传结果：已预上传时等待并复用其结果，否则立即上传
+        
+        失败的预上传结果不会保留，下次调用时重新上传。
+        
+        Args:
+            image_path: 图片本地路径
+            permanent: 是否上传为永久素材
+            
+        Returns:
+            上传结果字典
+        """
+        key = (image_path, permanent)
+        with self._prefetch_lock:
+            future = self._prefetched.get(key)
+        
+        if future is None:
+            return self.upload(image_path, permanent)
+        
+        result = future.result()
+        if not result['success']:
+            with self._prefetch_lock:
+                if self._prefetched.get(key) is future:
+                    del self._prefetched[key]
+        return result
+    
+    def upload_bytes(self, data: bytes, filename: str, permanent: bool = True) -> Dict:
+        """上传内存中的图片数据，无需先写入磁盘，内容与已上传的图片相同时直接复用结果
+        
+        Args:
+            data: 图片内容
+            filename: 上传时使用的文件名
+            permanent: 是否上传为永久素材
+            
+        Returns:
+            上传结果字典
+        """
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return self._upload_deduplicated(digest, permanent, partial(self._upload_bytes, data, filename, permanent),
+                                         filename, {'local_path': None, 'filename': filename})
+    
+    def _upload_bytes(self, data: bytes, filename: str, permanent: bool) -> Dict:
+        """执行一次内存图片数据的上传"""
+        result = {
+            'local_path': None,
+            'filename': filename,
+            'success': False,
+            'media_id': None,
+            'media_url': None,
+            'error': None
+        }
+        
+        try:
+            if len(data) > config.MAX_IMAGE_SIZE:
+                raise ValueError(f"图片文件过大: {format_file_size(len(data))}")
+            
+            access_token = self.get_access_token()
+            
+            if self.logger.isEnabledFor(logging.INFO):
+                self.logger.info(f"开始上传{'永久' if permanent else '临时'}图片: {filename} ({format_file_size(len(data))})")
+            
+            if permanent:
+                response_data = self._post_media(self.UPLOAD_IMG_URL, {'access_token': access_token}, filename, data)
+                key = 'url'
+            else:
+                params = {'access_token': access_token, 'type': 'image'}
+                response_data = self._post_media(self.UPLOAD_URL, params, filename, data)
+                key = 'media_id'
+            
+            if key not in response_data:
+                error_msg = response_data.get('errmsg', '未知错误')
+                error_code = response_data.get('errcode', -1)
+                raise Exception(f"上传失败: [{error_code}] {error_msg}")
+            
+            result.update({
+                'success': True,
+                'media_id': response_data.get('media_id', ''),
+                'media_url': response_data.get('url', '')
+            })
+            
+            self.logger.info(f"图片上传成功: {filename} -> {response_data[key]}")
+            
+        except Exception as e:
+            result['error'] = str(e)
+            self.logger.error(f"上传失败 {filename}: {str(e)}")
+        
+        return result
+    
+    def _post_media(self, url: str, params: Dict, filename: str, media) -> Dict:
+        """以multipart/form-data提交图片并返回解析后的JSON
+        
+        每张图片在自己的任务内独立重试：网络错误、429和5xx以及微信的系统繁忙、频率超限错误
+        按带随机抖动的指数退避重试（响应带Retry-After时按其等待）；访问令牌失效时（如已过期或
+        被其他进程刷新）刷新一次令牌后重试；达到每日调用上限后不再重试，之后的上传也直接返回该错误。
+        
+        Args:
+            url: 上传接口地址
+            params: 查询参数
+            filename: 文件名
+            media: 文件对象或bytes
+            
+        Returns:
+            接口返回的JSON数据
+        """
+        # 内容类型只判断一次，重试时复用
+        content_type = self._guess_content_type(filename, media)
+        token_renewed = False
+        attempt = 0
+        while True:
+            if self._quota_error is not None:
+                return self._quota_error
+            
+            if hasattr(media, 'seek'):
+                media.seek(0)
+            
+            try:
+                data = self._send_media(url, params, filename, media, content_type)
+            except requests.exceptions.RequestException as e:
+                if attempt >= config.MAX_RETRIES or not is_retryable_error(e):
+                    raise
+                delay = self._retry_delay(attempt, getattr(e, 'response', None))
+                self.logger.warning(f"上传请求失败，{delay:.1f}秒后进行第 {attempt + 1} 次重试 {filename}: {str(e)}")
+            else:
+                errcode = data.get('errcode')
+                if errcode in self.TOKEN_ERROR_CODES and not token_renewed:
+                    token_renewed = True
+                    self.logger.info(f"访问令牌已失效 [{errcode}]，刷新后重试")
+                    params = dict(params, access_token=self._renew_invalid_token(params['access_token']))
+                    continue
+                if errcode in self.QUOTA_ERROR_CODES:
+                    self._quota_error = data
+                    self.logger.error(f"微信接口调用次数已达每日上限 [{errcode}]，停止上传")
+                    return data
+                if errcode not in self.THROTTLE_ERROR_CODES or attempt >= config.MAX_RETRIES:
+                    return data
+                # 频率超限时等待更长时间
+                delay = self._retry_delay(attempt + 1)
+                self.logger.warning(f"微信接口繁忙 [{errcode}]，{delay:.1f}秒后进行第 {attempt + 1} 次重试 {filename}")
+            
+            time.sleep(delay)
+            attempt += 1
+    
+    def _retry_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """计算重试前的等待秒数：响应带Retry-After时按其等待，否则为带随机抖动的指数退避"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), config.UPLOAD_BACKOFF_MAX)
+        return min(2 ** attempt, config.UPLOAD_BACKOFF_MAX) + random.random()
+    
+    def _guess_content_type(self, filename: str, media) -> str:
+        """根据文件头判断图片的内容类型，无法识别时按文件扩展名猜测，默认image/jpeg"""
+        if hasattr(media, 'read'):
+            head = media.read(16)
+            media.seek(0)
+        else:
+            head = media[:16]
+        
+        fmt = detect_image_format(head)
+        if fmt:
+            return f"image/{fmt}"
+        return mimetypes.guess_type(filename)[0] or 'image/jpeg'
+    
+    def _send_media(self, url: str, params: Dict, filename: str, media, content_type: str) -> Dict:
+        """发送一次上传请求
+        
+        使用MultipartEncoder按块读取文件并流式发送，不会先在内存中拼出完整的请求体；
+        编码器能算出总长度，请求带Content-Length而不是分块传输。
+        """
+        encoder = MultipartEncoder(fields={
+            'media': (filename, media, content_type)
+        })
+        
+        self._upload_limiters[url].acquire()
+        response = self.session.post(
+            url,
+            params=params,
+            data=encoder,
+            headers={'Content-Type': encoder.content_type},
+            timeout=config.REQUEST_TIMEOUT * 2  # 上传时间可能较长
+        )
+        response.raise_for_status()
+        
+        return orjson.loads(response.content)
+    
+    def upload_images_batch(self, image_paths: List[str], permanent: bool = True,
+                            max_workers: Optional[int] = None) -> List[Dict]:
         """批量上传图片
         
         Args:
             image_paths: 图片路径列表
             permanent: 是否上传为永久素材
+            max_workers: 最大并发数，默认使用config.UPLOAD_CONCURRENCY
             
         Returns:
-            上传结果列表
+            上传结果列表（按完成顺序）
         """
         if not image_paths:
             return []
         
         self.logger.info(f"开始批量上传 {len(image_paths)} 张图片 ({'永久' if permanent else '临时'}素材)")
         
-        results = []
+        max_workers = max_workers or config.UPLOAD_CONCURRENCY
         
-        # 使用进度条显示上传进度
-        with tqdm(total=len(image_paths), desc="上传图片", unit="张") as pbar:
-            for image_path in image_paths:
-                if permanent:
-                    result = self.upload_permanent_image(image_path)
-                else:
-                    result = self.upload_image(image_path)
-                
-                results.append(result)
-                
-                # 更新进度条
-                if result['success']:
-                    pbar.set_postfix(status="成功", file=os.path.basename(image_path))
-                else:
-                    pbar.set_postfix(status="失败", error=result['error'][:30])
-                
-                pbar.update(1)
-                
-                # 避免请求过于频繁
-                time.sleep(0.1)
+        # 先统一检查所有文件，缺失或过大的文件直接记为失败，不获取令牌也不调用接口
+        valid_paths, results = self._preflight(image_paths)
+        if not valid_paths:
+            self.logger.info(f"批量上传完成: 成功 0 张, 失败 {len(results)} 张")
+            return results
+        
+        # 上传主要是等待网络，使用线程池并发上传，由限速器代替固定的间隔休眠控制请求频率
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(valid_paths))) as executor:
+            futures = [executor.submit(self.upload, image_path, permanent) for image_path in valid_paths]
+            
+            # 使用进度条显示上传进度，只在当前线程更新并限制重绘频率，上传线程不争用进度条的锁
+            with tqdm(total=len(valid_paths), desc="上传图片", unit="张",
+                      mininterval=0.1, miniters=max(1, len(valid_paths) // 200)) as pbar:
+                last_postfix = 0.0
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    
+                    # 更新进度条，状态信息最多每0.1秒刷新一次
+                    now = time.monotonic()
+                    if now - last_postfix > 0.1:
+                        if result['success']:
+                            pbar.set_postfix(status="成功", file=os.path.basename(result['local_path']), refresh=False)
+                        else:
+                            pbar.set_postfix(status="失败", error=result['error'][:30], refresh=False)
+                        last_postfix = now
+                    
+                    pbar.update(1)
         
         # 统计结果
         successful = sum(1 for r in results if r['success'])
@@ -302,48 +850,104 @@ class WeChatUploader:
         
         return results
     
+    def _preflight(self, image_paths: List[str]) -> Tuple[List[str], List[Dict]]:
+        """上传前检查所有文件是否存在以及大小是否超限
+        
+        stat在网络文件系统上有明显延迟，用线程池并发完成。
+        
+        Returns:
+            (可以上传的路径列表, 不能上传的文件的失败结果列表)
+        """
+        with ThreadPoolExecutor(max_workers=min(8, len(image_paths))) as executor:
+            sizes = list(executor.map(_file_size_or_none, image_paths))
+        
+        valid_paths = []
+        failed_results = []
+        for image_path, file_size in zip(image_paths, sizes):
+            if file_size is None:
+                error = f"图片文件不存在: {image_path}"
+            elif file_size > config.MAX_IMAGE_SIZE:
+                error = f"图片文件过大: {format_file_size(file_size)}"
+            else:
+                valid_paths.append(image_path)
+                continue
+            
+            self.logger.error(f"上传失败 {image_path}: {error}")
+            failed_results.append({
+                'local_path': image_path,
+                'success': False,
+                'media_id': None,
+                'media_url': None,
+                'error': error
+            })
+        
+        return valid_paths, failed_results
+    
     def retry_failed_uploads(self, failed_results: List[Dict], permanent: bool = True, max_retries: int = None) -> List[Dict]:
         """重试失败的上传
         
+        每张图片各自记录重试次数，失败后按自己的退避时间重新提交到同一个线程池，
+        不再每轮重新发起一次完整的批量上传、等待整轮结束后才开始下一轮。
+        
         Args:
             failed_results: 失败的上传结果列表
             permanent: 是否上传为永久素材
             max_retries: 最大重试次数
             
         Returns:
-            重试结果列表
+            每张图片最后一次重试的结果列表
         """
         if max_retries is None:
             max_retries = config.MAX_RETRIES
         
-        failed_paths = [r['local_path'] for r in failed_results if not r['success']]
-        if not failed_paths:
+        # 内存上传的结果没有本地路径，无法重试
+        failed_paths = list(dict.fromkeys(r['local_path'] for r in failed_results if not r['success'] and r['local_path']))
+        if not failed_paths or max_retries <= 0:
             return []
         
         self.logger.info(f"开始重试 {len(failed_paths)} 个失败的上传")
         
-        retry_results = []
+        final_results = {}
+        # 正在上传的任务到(路径, 第几次重试)的映射，以及按重新提交时间排序的待重试堆
+        pending = {}
+        delayed = []
+        sequence = count()
         
-        for attempt in range(max_retries):
-            if not failed_paths:
-                break
+        with ThreadPoolExecutor(max_workers=min(config.UPLOAD_CONCURRENCY, len(failed_paths))) as executor, \
+                tqdm(total=len(failed_paths), desc="重试上传", unit="张",
+                     mininterval=0.1, miniters=max(1, len(failed_paths) // 200)) as pbar:
+            for image_path in failed_paths:
+                pending[executor.submit(self.upload, image_path, permanent)] = (image_path, 1)
             
-            self.logger.info(f"第 {attempt + 1} 次重试，剩余 {len(failed_paths)} 个")
-            
-            # 重试上传
-            current_results = self.upload_images_batch(failed_paths, permanent)
-            retry_results.extend(current_results)
-            
-            # 更新失败列表
-            failed_paths = [r['local_path'] for r in current_results if not r['success']]
-            
-            # 如果还有失败的，等待一段时间再重试
-            if failed_paths and attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                self.logger.info(f"等待 {wait_time} 秒后重试")
-                time.sleep(wait_time)
+            while pending or delayed:
+                # 提交已到重试时间的图片
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    _, _, image_path, attempt = heapq.heappop(delayed)
+                    pending[executor.submit(self.upload, image_path, permanent)] = (image_path, attempt)
+                
+                if not pending:
+                    time.sleep(delayed[0][0] - now)
+                    continue
+                
+                timeout = delayed[0][0] - now if delayed else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image_path, attempt = pending.pop(future)
+                    result = future.result()
+                    if result['success'] or attempt >= max_retries:
+                        final_results[image_path] = result
+                        pbar.update(1)
+                        continue
+                    
+                    delay = self._retry_delay(attempt - 1)
+                    self.logger.info(f"第 {attempt} 次重试失败，{delay:.1f}秒后再次重试 {image_path}")
+                    heapq.heappush(delayed, (time.monotonic() + delay, next(sequence), image_path, attempt + 1))
+        
+        successful = sum(1 for r in final_results.values() if r['success'])
+        self.logger.info(f"重试完成: 成功 {successful} 张, 失败 {len(final_results) - successful} 张")
         
-        return retry_results
+        return list(final_results.values())
     
     def get_media_info(self, media_id: str) -> Dict:
         """获取媒体文件信息
@@ -355,25 +959,32 @@ class WeChatUploader:
             媒体文件信息
         """
         try:
-            access_token = self.get_access_token()
-            
             params = {
-                'access_token': access_token,
+                'access_token': self.get_access_token(),
                 'media_id': media_id
             }
             
-            response = self.session.get(
-                "https://api.weixin.qq.com/cgi-bin/media/get",
-                params=params,
-                timeout=config.REQUEST_TIMEOUT
-            )
-            response.raise_for_status()
-            
-            # 如果返回的是JSON，说明有错误
-            if response.headers.get('content-type', '').startswith('application/json'):
-                data = response.json()
-                error_msg = data.get('errmsg', '未知错误')
+            # 访问令牌失效时刷新一次令牌后重试
+            token_renewed = False
+            while True:
+                response = self.session.get(
+                    "https://api.weixin.qq.com/cgi-bin/media/get",
+                    params=params,
+                    timeout=config.REQUEST_TIMEOUT
+                )
+                response.raise_for_status()
+                
+                # 如果返回的是JSON，说明有错误
+                if not response.headers.get('content-type', '').startswith('application/json'):
+                    break
+                
+                data = orjson.loads(response.content)
                 error_code = data.get('errcode', -1)
+                if error_code in self.TOKEN_ERROR_CODES and not token_renewed:
+                    token_renewed = True
+                    params['access_token'] = self._renew_invalid_token(params['access_token'])
+                    continue
+                error_msg = data.get('errmsg', '未知错误')
                 raise Exception(f"获取媒体信息失败: [{error_code}] {error_msg}")
             
             return {
@@ -390,7 +1001,28 @@ class WeChatUploader:
                 'error': str(e)
             }
     
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
+    def close(self):
+        """关闭会话及其中的空闲连接，尚未开始的预上传不再执行"""
+        if self._prefetch_executor is not None:
+            for future in self._prefetched.values():
+                future.cancel()
+            self._prefetch_executor.shutdown(wait=False)
+            self._prefetch_executor = None
+        self.session.close()
+    
     def __del__(self):
-        """析构函数，关闭会话"""
+        """析构函数，关闭会话
+        
+        可能在解释器退出时才被调用，此时模块可能已被清理，忽略关闭时的异常。
+        """
         if hasattr(self, 'session'):
-            self.session.close()
\ No newline at end of file
+            try:
+                self.session.close()
+            except Exception:
+                pass
\ No newline at end of file